@@ -1,16 +1,24 @@
 import os
-import json
+import functools
 from io import BytesIO
-from pdf2image import convert_from_path
+from typing import Callable
 import streamlit as st
 import streamlit.components.v1 as components
-from docling_core.types.doc.document import DoclingDocument
-from nice_processing import init_processor_and_model, pdf_to_docling
-from pdfhandler import PDFHandler, Section, SectionSlicer
+from nice_processing import BATCH_SIZE, DOCLING_JSON, INFERENCE_BACKEND, INFERENCE_BACKENDS, NUM_WORKERS, USE_TEXT_LAYER
+from jobs import DONE, FAILED, JobQueue, list_jobs
+from pdfhandler import PDFHandler, Section, SectionRenderCache, SectionSlicer
+from document_cache import DocumentCache
 
 STAGE_PATH = "/workspaces/NicerSlicer/stage"
-DOCLING_JSON = "docling.json"
-SECTION_JSON = "sections.json"
+CACHE_PATH = "/workspaces/NicerSlicer/cache"
+# load the VLLM in the job workers when the server handles its first run instead of on the first upload
+WARM_UP_MODEL = True
+# seconds between two refreshes of the job progress
+JOB_POLL_INTERVAL = 2
+# finished jobs listed below the queued and running ones
+RECENT_FINISHED_JOBS = 5
+# sections rendered around the selected section in the slice tab, more are loaded page by page
+SLICE_WINDOW_SIZE = 40
 
 # ---- STREAMLIT STYLE ----
 BRACKET_COLORS = ["red", "blue", "orange", "green"]
@@ -59,23 +67,66 @@ def id_from_section_option(section_option: str) -> int:
     return int(section_option.split("-")[0].strip())
 
 
+def section_window(pdf_handler: PDFHandler, section_index: int, slider_start: int, slider_end: int,
+                   window_size: int, pages_before: int, pages_after: int) -> range:
+    """Sections rendered in the slice tab: a window around the selected section that covers the slider range"""
+    touched_sections = pdf_handler.sections_in_range(slider_start, slider_end)
+    first = min(max(0, section_index - window_size // 2), touched_sections.start)
+    stop = max(first + window_size, touched_sections.stop)
+    return range(max(0, first - pages_before * window_size),
+                 min(len(pdf_handler.sections), stop + pages_after * window_size))
+
+
+def load_more_sections(direction: str):
+    st.session_state[f"window_pages_{direction}"] += 1
+
+
+def document_locked(func: Callable) -> Callable:
+    """Run an edit callback or dialog under the lock of the selected document"""
+    @functools.wraps(func)
+    def locked(*args, **kwargs):
+        with document_cache.lock(st.session_state.selected_document):
+            return func(*args, **kwargs)
+    return locked
+
+
+@document_locked
 def discard_section(pdf_handler: PDFHandler):
     # set section to discard status
-    pdf_handler.sections[st.session_state.selected_section_index].discarded = True
+    pdf_handler.discard_section(st.session_state.selected_section_index)
     # store state
-    pdf_handler.save_state(os.path.join(STAGE_PATH, st.session_state.selected_document, SECTION_JSON))
+    document_cache.save_state(st.session_state.selected_document, pdf_handler)
     # update session state
     st.session_state.discarded_sections = pdf_handler.get_discarded_sections()
 
+
+@document_locked
+def undo_edit(pdf_handler: PDFHandler, redo: bool = False):
+    # revert or reapply the last section edit
+    if pdf_handler.redo() if redo else pdf_handler.undo():
+        document_cache.save_state(st.session_state.selected_document, pdf_handler)
+        st.session_state.discarded_sections = pdf_handler.get_discarded_sections()
+
 # ---- Cached Methods ----
 
 
-@st.cache_data
-def load_pdf_markdown(doc_folder: str) -> str:
-    # init DoclingDocument from json
-    docling = DoclingDocument.load_from_json(os.path.join(STAGE_PATH, doc_folder, DOCLING_JSON))
-    return docling.export_to_markdown(image_placeholder="")
+@st.cache_resource
+def get_document_cache() -> DocumentCache:
+    # parsed documents shared by all sessions, rebuilt when their files change on disk
+    return DocumentCache(STAGE_PATH)
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    # one job queue per server process shared by all sessions
+    return JobQueue(STAGE_PATH, CACHE_PATH, warm_up=WARM_UP_MODEL)
+
 
+# ---- INGESTION JOBS ----
+job_queue = get_job_queue()
+
+# ---- DOCUMENTS ----
+document_cache = get_document_cache()
 
 # ---- STREAMLIT SESSION STATE ----
 if "selected_document" not in st.session_state:
@@ -88,11 +139,16 @@ if "discarded_sections" not in st.session_state:
     st.session_state.discarded_sections = []
 if "selected_color" not in st.session_state:
     st.session_state.selected_color = None
+if "render_cache" not in st.session_state:
+    st.session_state.render_cache = SectionRenderCache()
+if "window_anchor" not in st.session_state:
+    st.session_state.window_anchor = None
 
 # ---- STREAMLIT Dialogs ----
 
 
 @st.dialog("Join Sections")
+@document_locked
 def join_sections(section_index, pdf_handler):
 
     # set joinable sections
@@ -155,12 +211,13 @@ def join_sections(section_index, pdf_handler):
         # update discard session state
         st.session_state.discarded_sections = pdf_handler.get_discarded_sections()
 
-        pdf_handler.save_state(os.path.join(STAGE_PATH, st.session_state.selected_document, SECTION_JSON))
+        document_cache.save_state(st.session_state.selected_document, pdf_handler)
 
         st.rerun()
 
 
 @st.dialog("Split Section")
+@document_locked
 def split_sections(section_index: int, pdf_handler: PDFHandler, slider_start: int, slider_end: int):
 
     section = pdf_handler.sections[section_index]
@@ -199,7 +256,7 @@ def split_sections(section_index: int, pdf_handler: PDFHandler, slider_start: in
         pdf_handler.split_sections(section_index, section_separator, title1, title2)
         # update discard session state
         st.session_state.discarded_sections = pdf_handler.get_discarded_sections()
-        pdf_handler.save_state(os.path.join(STAGE_PATH, st.session_state.selected_document, SECTION_JSON))
+        document_cache.save_state(st.session_state.selected_document, pdf_handler)
 
         st.rerun()
 
@@ -207,6 +264,7 @@ def split_sections(section_index: int, pdf_handler: PDFHandler, slider_start: in
 
 
 @st.dialog("Commit Section")
+@document_locked
 def commmit_section(section_index: int, pdf_handler: PDFHandler, slider_start: int, slider_end: int):
     # TODO: adjascent sections and discard section
     slicer = SectionSlicer(
@@ -283,7 +341,7 @@ def commmit_section(section_index: int, pdf_handler: PDFHandler, slider_start: i
 
                 st.session_state.discarded_sections = discarded_sections
 
-            pdf_handler.save_state(os.path.join(STAGE_PATH, st.session_state.selected_document, SECTION_JSON))
+            document_cache.save_state(st.session_state.selected_document, pdf_handler)
 
             st.rerun()
 
@@ -306,85 +364,101 @@ with st.sidebar:
 
     st.session_state.selected_document = st.selectbox(
         "Select your Document",
-        [doc_folder for doc_folder in os.listdir(STAGE_PATH)]
+        # documents still being ingested have no docling.json yet
+        [doc_folder for doc_folder in os.listdir(STAGE_PATH)
+         if os.path.exists(os.path.join(STAGE_PATH, doc_folder, DOCLING_JSON))]
     )
     with st.status("Load Document..."):
-        dolcing_markdown = load_pdf_markdown(st.session_state.selected_document)
-        pdf_handler = PDFHandler.from_markdown(dolcing_markdown)
-
-        if os.path.exists(os.path.join(STAGE_PATH, st.session_state.selected_document, SECTION_JSON)):
-            pdf_handler.load_state(os.path.join(STAGE_PATH, st.session_state.selected_document, SECTION_JSON))
-
-    st.divider()
-
-    st.header("Section Editor")
-
-    # section selector
-    st.session_state.selected_section_index = id_from_section_option(st.selectbox(
-        "Edit Section",
-        options=[format_section_option(s) for s in pdf_handler.sections],
-        key="section-select"
-    ))
-    selected_section = pdf_handler.sections[st.session_state.selected_section_index]
-
-    # build slider for section boundaries
-    lower_boundaries = max(0, selected_section.spans[0] - 80)
-    range_options = [i for i in range(lower_boundaries, selected_section.spans[1] + 80)]
-    slider_start, slider_end = st.select_slider(
-        "Section Boundaries",
-        options=range_options,
-        value=(selected_section.spans[0], selected_section.spans[1]),
-        key="chunk-boundaries"
-    )
-
-    side_col1, side_col2, side_col3 = st.columns([0.1, 1, 0.1], vertical_alignment="bottom")
-    with side_col2:
-        st.markdown(
-            """
-            <style>
-            div.stButton > button {
-                width: 100%;
-            }
-            div.stDownloadButton > button {
-                width: 100%
-            }
-            </style>
-            """,
-            unsafe_allow_html=True
-        )
-        if st.button("Commit Section", key="commit-section-boundaries", icon=":material/playlist_add:"):
-            commmit_section(st.session_state.selected_section_index, pdf_handler, slider_start, slider_end)
-    st.divider()
-    st.header("Section Operations")
-    side_col_4, side_col_5, side_col_6 = st.columns(3)
-    with side_col_4:
-        st.button(
-            "Discard",
-            type="tertiary",
-            key="discard_section",
-            icon=":material/delete:",
-            help="Delete the selected section",
-            on_click=discard_section,
-            args=[pdf_handler]
+        pdf_handler = document_cache.get(st.session_state.selected_document)
+    stale_state = document_cache.stale_state(st.session_state.selected_document)
+    if stale_state:
+        st.warning(f"The sections were edited for an earlier ingestion of this document and start over, "
+                   f"the old ones were moved to {os.path.basename(stale_state)}", icon="⚠️")
+
+    # the handler is shared with the other sessions, edits of theirs wait until this run read it
+    with document_cache.lock(st.session_state.selected_document):
+        st.divider()
+
+        st.header("Section Editor")
+
+        # section selector
+        st.session_state.selected_section_index = id_from_section_option(st.selectbox(
+            "Edit Section",
+            options=[format_section_option(s) for s in pdf_handler.sections],
+            key="section-select"
+        ))
+        selected_section = pdf_handler.sections[st.session_state.selected_section_index]
+
+        # build slider for section boundaries
+        lower_boundaries = max(0, selected_section.spans[0] - 80)
+        range_options = [i for i in range(lower_boundaries, selected_section.spans[1] + 80)]
+        slider_start, slider_end = st.select_slider(
+            "Section Boundaries",
+            options=range_options,
+            value=(selected_section.spans[0], selected_section.spans[1]),
+            key="chunk-boundaries"
         )
-    with side_col_5:
-        if st.button("Join", type="tertiary", key="join-sections",
-                     icon=":material/merge_type:", help="Join this section with another one"):
-            join_sections(st.session_state.selected_section_index, pdf_handler, )
-    with side_col_6:
-        if st.button("Split", type="tertiary", key="split-sections",
-                     icon=":material/call_split:", help="Split this section into two"):
-            split_sections(st.session_state.selected_section_index, pdf_handler, slider_start, slider_end)
 
-    st.divider()
-    st.download_button(
-        "Download Sections",
-        key="download-sections",
-        icon=":material/download:",
-        data=pdf_handler.to_json(),
-        mime="application/json",
-        file_name=st.session_state.selected_document
-    )
+        side_col1, side_col2, side_col3 = st.columns([0.1, 1, 0.1], vertical_alignment="bottom")
+        with side_col2:
+            st.markdown(
+                """
+                <style>
+                div.stButton > button {
+                    width: 100%;
+                }
+                div.stDownloadButton > button {
+                    width: 100%
+                }
+                </style>
+                """,
+                unsafe_allow_html=True
+            )
+            if st.button("Commit Section", key="commit-section-boundaries", icon=":material/playlist_add:"):
+                commmit_section(st.session_state.selected_section_index, pdf_handler, slider_start, slider_end)
+        st.divider()
+        st.header("Section Operations")
+        side_col_4, side_col_5, side_col_6 = st.columns(3)
+        with side_col_4:
+            st.button(
+                "Discard",
+                type="tertiary",
+                key="discard_section",
+                icon=":material/delete:",
+                help="Delete the selected section",
+                on_click=discard_section,
+                args=[pdf_handler]
+            )
+        with side_col_5:
+            if st.button("Join", type="tertiary", key="join-sections",
+                         icon=":material/merge_type:", help="Join this section with another one"):
+                join_sections(st.session_state.selected_section_index, pdf_handler, )
+        with side_col_6:
+            if st.button("Split", type="tertiary", key="split-sections",
+                         icon=":material/call_split:", help="Split this section into two"):
+                split_sections(st.session_state.selected_section_index, pdf_handler, slider_start, slider_end)
+        side_col_7, side_col_8 = st.columns(2)
+        with side_col_7:
+            st.button("Undo", type="tertiary", key="undo-edit", icon=":material/undo:",
+                      help="Revert the last section edit", disabled=pdf_handler.history_position == 0,
+                      on_click=undo_edit, args=[pdf_handler])
+        with side_col_8:
+            st.button("Redo", type="tertiary", key="redo-edit", icon=":material/redo:",
+                      help="Reapply the last reverted edit",
+                      disabled=pdf_handler.history_position == len(pdf_handler.history),
+                      on_click=undo_edit, args=[pdf_handler, True])
+
+        st.divider()
+        window_size = st.number_input("Sections per Page", min_value=1, value=SLICE_WINDOW_SIZE,
+                                      help="Sections rendered around the selected section in the slice tab")
+        st.download_button(
+            "Download Sections",
+            key="download-sections",
+            icon=":material/download:",
+            data=pdf_handler.to_json(),
+            mime="application/json",
+            file_name=st.session_state.selected_document
+        )
 
 
 # ---- UPLOAD TAB ----
@@ -397,57 +471,84 @@ with upload_tab:
 
         pdf_doc_title = st.text_input("Document Title", placeholder="Your PDF Title")
         uploaded_file = st.file_uploader("Choose your pdf", accept_multiple_files=False)
+        batch_size = st.number_input("Pages per Batch", min_value=1, max_value=32, value=BATCH_SIZE)
+        num_workers = st.number_input("Worker Processes", min_value=1, max_value=os.cpu_count() or 1, value=NUM_WORKERS,
+                                      help="Each worker loads its own model replica")
+        backend = st.selectbox("Inference Backend", INFERENCE_BACKENDS,
+                               index=INFERENCE_BACKENDS.index(INFERENCE_BACKEND),
+                               help="Run `python benchmarks.py backends` to find the fastest backend of this machine")
+        use_text_layer = st.checkbox("Use PDF Text Layer", value=USE_TEXT_LAYER,
+                                     help="Born-digital pages are read from the PDF text instead of the VLLM")
 
         if st.button("Process", type="primary", disabled=False if uploaded_file else True, icon="💫"):
-            with st.status("Processing uploaded PDF...", expanded=True) as status:
-                st.write("Reading PDF...")
-                # creat sub folder and file path
-                dir_path = os.path.join(STAGE_PATH, pdf_doc_title)
-                if not os.path.exists(dir_path):
-                    os.mkdir(dir_path)
-                file_path = os.path.join(dir_path, f"{pdf_doc_title}.pdf")
-                # store pdf file
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getvalue())
-
-                # convert pdf to images
-                st.write("Convert PDF to Images...")
-                images = convert_from_path(file_path, dpi=300)
-
-                st.write("Initialize VLLM Model")
-                processor, vllm = init_processor_and_model()
-
-                st.write("Processing PDF to Docling...")
-                docling_doc = pdf_to_docling(
-                    pdf_images=images,
-                    pdf_title=pdf_doc_title,
-                    processor=processor,
-                    model=vllm
-                )
-
-                st.write("Persisting DoclingDocument")
-                docling_path = os.path.join(dir_path, "docling.json")
-
-                with open(docling_path, "w") as fh:
-                    json.dump(docling_doc.export_to_dict(), fh)
+            try:
+                job_queue.submit(pdf_doc_title, uploaded_file.getvalue(), batch_size=batch_size,
+                                 num_workers=num_workers, backend=backend, use_text_layer=use_text_layer)
+                st.success(f"Queued {pdf_doc_title} for processing")
+            except ValueError as e:
+                st.warning(str(e), icon="⚠️")
+
+        # only this fragment reruns while polling, slicing in the other tab is not blocked
+        @st.fragment(run_every=JOB_POLL_INTERVAL)
+        def render_jobs():
+            for job in list_jobs(STAGE_PATH, finished_limit=RECENT_FINISHED_JOBS):
+                progress = job["progress"]
+                with st.container(border=True):
+                    st.markdown(f"**{job['document']}** - {job['state']} ({job['options']['backend']} backend)")
+                    if progress["total"]:
+                        st.progress(progress["done"] / progress["total"],
+                                    text=f"{progress['done']} / {progress['total']} pages")
+                    if job["state"] == DONE:
+                        for message in job.get("messages", []):
+                            st.caption(message)
+                        if job.get("flagged"):
+                            flagged = ", ".join(f"page {page_number} ({reason})"
+                                                for page_number, reason in job["flagged"].items())
+                            st.warning(f"These pages hit the generation budget and should be reviewed: {flagged}",
+                                       icon="⚠️")
+                    elif job["state"] == FAILED:
+                        st.error(job["error"])
+
+        st.divider()
+        st.subheader("Processing Jobs")
+        render_jobs()
 
 
 # ---- Slice TAB ----
 with slice_tab:
     if st.session_state.selected_document:
-        for section_index, section in enumerate(pdf_handler.sections):
-            if section.id_ in st.session_state.discarded_sections:
-
-                section.discarded = True
-            # set color and state bool
-            section_color = BRACKET_COLORS[section_index % len(BRACKET_COLORS)]
-            is_selected = True if section_index == st.session_state.selected_section_index else False
-            if is_selected:
-                st.session_state.selected_color = section_color
-            # get text from section object
-            txt = section.format_section_text(
-                slider_start, slider_end, cursor_color=st.session_state.selected_color, is_selected=is_selected, index=section_index, color=section_color
-            )
-            st.markdown(txt, unsafe_allow_html=True)
+        with document_cache.lock(st.session_state.selected_document):
+            # the loaded pages around a section are dropped when another section gets selected
+            window_anchor = (st.session_state.selected_document, st.session_state.selected_section_index)
+            if st.session_state.window_anchor != window_anchor:
+                st.session_state.window_anchor = window_anchor
+                st.session_state.window_pages_before = 0
+                st.session_state.window_pages_after = 0
+            window = section_window(pdf_handler, st.session_state.selected_section_index, slider_start, slider_end,
+                                    window_size, st.session_state.window_pages_before,
+                                    st.session_state.window_pages_after)
+
+            if window.start > 0:
+                st.button(f"Load earlier sections ({window.start} more)", key="load-earlier-sections",
+                          icon=":material/expand_less:", type="tertiary", on_click=load_more_sections, args=["before"])
+
+            for section_index in window:
+                section = pdf_handler.sections[section_index]
+                # set color and state bool
+                section_color = BRACKET_COLORS[section_index % len(BRACKET_COLORS)]
+                is_selected = True if section_index == st.session_state.selected_section_index else False
+                if is_selected:
+                    st.session_state.selected_color = section_color
+                # get text from section object, sections the change does not touch come from the render cache
+                txt = st.session_state.render_cache.format_section_text(
+                    section, slider_start, slider_end, cursor_color=st.session_state.selected_color,
+                    is_selected=is_selected, index=section_index, color=section_color
+                )
+                st.markdown(txt, unsafe_allow_html=True)
+
+            if window.stop < len(pdf_handler.sections):
+                st.button(f"Load later sections ({len(pdf_handler.sections) - window.stop} more)",
+                          key="load-later-sections", icon=":material/expand_more:", type="tertiary",
+                          on_click=load_more_sections, args=["after"])
 
-        # st.markdown(docling_doc.export_to_markdown())
+            # st.markdown(docling_doc.export_to_markdown())
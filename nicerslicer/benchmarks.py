@@ -0,0 +1,338 @@
+"""
+Micro benchmarks for the document processing, run from the nicerslicer folder:
+
+    python benchmarks.py preprocessing my.pdf --pages 5
+    python benchmarks.py backends my.pdf --backend fp32 --backend int8
+    python benchmarks.py slicing --sections 200 --section-tokens 20000
+    python benchmarks.py state --sections 10000
+    python benchmarks.py edits --sections 200 --section-tokens 20000
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from typing import Callable, List, Optional
+
+from PIL import Image
+
+
+def _print_table(header: List[str], rows: List[List]):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    for row in [header, *rows]:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+def _timed(func: Callable):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def _bitmap_mb(image: Image.Image) -> float:
+    return image.width * image.height * len(image.getbands()) / 1024 ** 2
+
+
+def bench_preprocessing(pdf_path: str, pages: int, generate: bool):
+    """Compare 300 dpi rasterization with rendering at the resolution the model actually uses"""
+    from nice_processing import (MODEL_REGISTRY, RASTER_DPI, ProcessorPrompt, iter_pdf_pages, pdf_images_to_docling,
+                                 preprocess_page)
+
+    processor, model = MODEL_REGISTRY.get()
+    processor_prompt = ProcessorPrompt.of(processor)
+    max_edge = processor_prompt.max_edge
+    page_numbers = list(range(1, pages + 1))
+    variants = {
+        f"{RASTER_DPI} dpi": dict(page_numbers=page_numbers),
+        f"max edge {max_edge}px": dict(page_numbers=page_numbers, max_edge=max_edge),
+    }
+
+    rows = []
+    for name, raster_kwargs in variants.items():
+        images, raster_seconds = _timed(lambda: list(iter_pdf_pages(pdf_path, **raster_kwargs)))
+        _, preprocess_seconds = _timed(lambda: [
+            processor_prompt.inputs([preprocess_page(image, max_edge)]) for image in images
+        ])
+        row = [
+            name,
+            f"{sum(_bitmap_mb(image) for image in images) / len(images):.1f}",
+            f"{raster_seconds / len(images):.3f}",
+            f"{preprocess_seconds / len(images):.3f}",
+        ]
+        if generate:
+            _, generate_seconds = _timed(lambda: [pdf_images_to_docling([image], processor, model) for image in images])
+            row.append(f"{(raster_seconds + generate_seconds) / len(images):.3f}")
+        rows.append(row)
+
+    header = ["variant", "MB/page", "raster s/page", "preprocess s/page"] + (["end-to-end s/page"] if generate else [])
+    _print_table(header, rows)
+
+
+def bench_backends(pdf_path: str, pages: int, backends: List[str]):
+    """Measure generated tokens per second and latency per page of every inference backend"""
+    from nice_processing import MAX_IMAGE_EDGE, init_processor_and_model, iter_pdf_pages, pdf_images_to_docling
+
+    images = list(iter_pdf_pages(pdf_path, page_numbers=list(range(1, pages + 1)), max_edge=MAX_IMAGE_EDGE))
+
+    rows = []
+    for backend in backends:
+        (processor, model), load_seconds = _timed(lambda: init_processor_and_model(backend))
+        # the first page absorbs lazy initialization like torch.compile tracing
+        _, warm_up_seconds = _timed(
+            lambda processor=processor, model=model: pdf_images_to_docling(images[:1], processor, model)
+        )
+
+        tokens, seconds = 0, 0.0
+        for image in images:
+            (doctags,), page_seconds = _timed(
+                lambda image=image, processor=processor, model=model: pdf_images_to_docling([image], processor, model)
+            )
+            tokens += len(processor.tokenizer.encode(doctags, add_special_tokens=False))
+            seconds += page_seconds
+        rows.append([
+            backend,
+            f"{load_seconds:.1f}",
+            f"{warm_up_seconds:.1f}",
+            f"{tokens / seconds:.1f}",
+            f"{seconds / len(images):.2f}",
+        ])
+        del processor, model
+
+    _print_table(["backend", "load s", "first page s", "tokens/s", "s/page"], rows)
+
+
+def _synthetic_markdown(sections: int, section_tokens: int, seed: int = 0) -> str:
+    """Markdown with sections of about section_tokens words in paragraphs of varying length"""
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet,", "**contract**", "§", "12.3", "", "clause-\nbreak"]
+    markdown = []
+    for section_index in range(sections):
+        paragraphs, tokens = [f"Section {section_index}"], 0
+        while tokens < section_tokens:
+            paragraph = [rng.choice(words) for _ in range(rng.randint(5, 120))]
+            paragraphs.append(" ".join(paragraph))
+            tokens += len(paragraph) + 1
+        markdown.append("## " + "\n\n".join(paragraphs) + "\n\n")
+    return "".join(markdown)
+
+
+def _reference_join(tokens: List[str], start: int, end: int) -> str:
+    """Token list join the sections used before the offset index"""
+    result = []
+    for token in tokens[start:end]:
+        result.append("\n\n" if token == "<$NEWLINE$>" else token + " ")
+    return "".join(result).rstrip()
+
+
+def bench_slicing(markdown_path: Optional[str], sections: int, section_tokens: int, slices: int):
+    """Compare token list joins with offset indexed slicing of section text"""
+    from pdfhandler import PDFHandler
+
+    if markdown_path:
+        with open(markdown_path, "r") as fh:
+            markdown = fh.read()
+    else:
+        markdown = _synthetic_markdown(sections, section_tokens)
+    pdf_handler, build_seconds = _timed(lambda: PDFHandler.from_markdown(markdown))
+    _, render_seconds = _timed(lambda: pdf_handler.store.join(0, 1))
+
+    rng = random.Random(1)
+    section_tokens = [section.tokens for section in pdf_handler.sections]
+    ranges = []
+    for _ in range(slices):
+        section_index = rng.randrange(len(pdf_handler.sections))
+        start, end = sorted(rng.randint(0, len(section_tokens[section_index])) for _ in range(2))
+        ranges.append((section_index, start, end))
+
+    reference, reference_seconds = _timed(lambda: [
+        _reference_join(section_tokens[section_index], start, end) for section_index, start, end in ranges
+    ])
+    indexed, indexed_seconds = _timed(lambda: [
+        pdf_handler.sections[section_index].join_tokens(start, end) for section_index, start, end in ranges
+    ])
+    if reference != indexed:
+        raise AssertionError("offset indexed slices differ from the token list joins")
+
+    print(f"{len(pdf_handler.sections)} sections, {len(pdf_handler.store)} tokens, "
+          f"built in {build_seconds:.2f} s, rendered in {render_seconds:.2f} s")
+    _print_table(["variant", "ms/slice"], [
+        ["token list join", f"{reference_seconds / slices * 1000:.3f}"],
+        ["offset index", f"{indexed_seconds / slices * 1000:.3f}"],
+    ])
+
+
+def _reference_tokenize(text: str) -> List[str]:
+    """Tokenization every section did on its own before the document token store"""
+    tokens: List[str] = []
+    for line in text.split("\n\n"):
+        if line.split():
+            tokens += line.split(" ")
+            tokens.append("<$NEWLINE$>")
+    if tokens and tokens[-1] == "<$NEWLINE$>":
+        tokens.pop()
+    return tokens
+
+
+def _allocated_mb(func: Callable) -> float:
+    """MB func allocates and keeps alive through its result"""
+    tracemalloc.start()
+    try:
+        result = func()
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return memory / 1024 ** 2
+
+
+def bench_state(sections: int, section_tokens: int):
+    """Compare the indented json section state with token lists to the binary section state"""
+    from pdfhandler import PDFHandler
+
+    markdown = _synthetic_markdown(sections, section_tokens)
+    pdf_handler = PDFHandler.from_markdown(markdown)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path, state_path = os.path.join(tmp_dir, "sections.json"), os.path.join(tmp_dir, "sections.state")
+        with open(json_path, "w") as fh:
+            section_dicts = [{**section.to_dict(), "tokens": section.tokens} for section in pdf_handler.sections]
+            json.dump({"sections": section_dicts}, fh, indent=3)
+        pdf_handler.save_state(state_path)
+
+        def load_json() -> list:
+            # sections owned their text and tokens and were built twice on load
+            with open(json_path, "r") as fh:
+                state = json.load(fh)
+            for section in state["sections"]:
+                section.pop("tokens")
+                section["tokens"] = _reference_tokenize(section["text"])
+            return [{**section, "tokens": _reference_tokenize(section["text"])} for section in state["sections"]]
+
+        def load_binary() -> PDFHandler:
+            loaded_handler = PDFHandler.from_markdown(markdown)
+            loaded_handler.load_state(state_path)
+            return loaded_handler
+
+        _, json_seconds = _timed(load_json)
+        _, state_seconds = _timed(lambda: pdf_handler.load_state(state_path))
+        _, binary_seconds = _timed(load_binary)
+        json_memory, binary_memory = _allocated_mb(load_json), _allocated_mb(load_binary)
+        json_kb, state_kb = os.path.getsize(json_path) / 1024, os.path.getsize(state_path) / 1024
+
+    print(f"{len(pdf_handler.sections)} sections, {len(pdf_handler.store)} tokens")
+    _print_table(["format", "file KB", "load s", "markdown + load s", "memory MB"], [
+        ["json with token lists", f"{json_kb:.0f}", f"{json_seconds:.2f}", "-", f"{json_memory:.1f}"],
+        ["binary state", f"{state_kb:.0f}", f"{state_seconds:.2f}", f"{binary_seconds:.2f}", f"{binary_memory:.1f}"],
+    ])
+    print("memory of the binary state includes the document token store")
+
+
+def _reference_edit(sections: List[dict], edit: tuple):
+    """String edit the sections did before they were views, every edit copies and re-tokenizes the text"""
+    operation, section_index, position = edit
+    if operation == "split":
+        tokens = sections[section_index]["tokens"]
+        parts = [_reference_join(tokens, 0, position), _reference_join(tokens, position, len(tokens))]
+        sections[section_index:section_index + 1] = [{"text": text, "tokens": _reference_tokenize(text)}
+                                                     for text in parts]
+    elif operation == "join":
+        text = sections[section_index]["text"] + "\n\n" + sections[section_index + 1]["text"]
+        sections[section_index:section_index + 2] = [{"text": text, "tokens": _reference_tokenize(text)}]
+    else:
+        sections[section_index] = {**sections[section_index], "discarded": True}
+
+
+def bench_edits(sections: int, section_tokens: int, edits: int):
+    """Compare string copying section edits with span edits on views over the document text"""
+    from pdfhandler import PDFHandler
+
+    markdown = _synthetic_markdown(sections, section_tokens)
+    pdf_handler = PDFHandler.from_markdown(markdown)
+    reference_sections = [{"text": section.text, "tokens": section.tokens} for section in pdf_handler.sections]
+
+    # the same random splits, joins and discards on both variants
+    rng = random.Random(2)
+    section_count, planned = len(pdf_handler.sections), []
+    for _ in range(edits):
+        operation = rng.choice(["split", "join", "discard"] if section_count > 1 else ["split", "discard"])
+        section_index = rng.randrange(section_count - (operation == "join"))
+        planned.append((operation, section_index, rng.random()))
+        section_count += {"split": 1, "join": -1, "discard": 0}[operation]
+
+    def edit_views():
+        for operation, section_index, position in planned:
+            section = pdf_handler.sections[section_index]
+            if operation == "split":
+                break_index = section.spans[0] + int(position * len(section))
+                pdf_handler.split_sections(section_index, break_index, section.title, section.title)
+            elif operation == "join":
+                pdf_handler.join_sections(section_index, section_index + 1, section.title)
+            else:
+                pdf_handler.discard_section(section_index)
+
+    def edit_strings():
+        for operation, section_index, position in planned:
+            section_tokens = len(reference_sections[section_index]["tokens"])
+            break_index = min(max(int(position * section_tokens), 1), section_tokens - 1)
+            _reference_edit(reference_sections, (operation, section_index, break_index))
+
+    _, views_seconds = _timed(edit_views)
+    _, strings_seconds = _timed(edit_strings)
+    if [token for section in pdf_handler.sections for token in section.tokens] != pdf_handler.get_pdf_tokens():
+        raise AssertionError("edited sections no longer cover the document tokens")
+
+    print(f"{len(pdf_handler.sections)} sections after {edits} edits, {len(pdf_handler.store)} tokens")
+    _print_table(["variant", "ms/edit"], [
+        ["string copies", f"{strings_seconds / edits * 1000:.3f}"],
+        ["span views", f"{views_seconds / edits * 1000:.3f}"],
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NicerSlicer micro benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    preprocessing = benchmarks.add_parser("preprocessing", help=bench_preprocessing.__doc__)
+    preprocessing.add_argument("pdf")
+    preprocessing.add_argument("--pages", type=int, default=5)
+    preprocessing.add_argument("--generate", action="store_true", help="include doctags generation per page")
+
+    backends = benchmarks.add_parser("backends", help=bench_backends.__doc__)
+    backends.add_argument("pdf")
+    backends.add_argument("--pages", type=int, default=3)
+    backends.add_argument("--backend", action="append", dest="backends", help="backend to measure, default all")
+
+    slicing = benchmarks.add_parser("slicing", help=bench_slicing.__doc__)
+    slicing.add_argument("--markdown", help="markdown file to slice, default a synthetic document")
+    slicing.add_argument("--sections", type=int, default=200)
+    slicing.add_argument("--section-tokens", type=int, default=20000)
+    slicing.add_argument("--slices", type=int, default=2000)
+
+    state = benchmarks.add_parser("state", help=bench_state.__doc__)
+    state.add_argument("--sections", type=int, default=10000)
+    state.add_argument("--section-tokens", type=int, default=300)
+
+    edits = benchmarks.add_parser("edits", help=bench_edits.__doc__)
+    edits.add_argument("--sections", type=int, default=200)
+    edits.add_argument("--section-tokens", type=int, default=20000)
+    edits.add_argument("--edits", type=int, default=500)
+
+    args = parser.parse_args()
+    if args.benchmark == "preprocessing":
+        bench_preprocessing(args.pdf, args.pages, args.generate)
+    elif args.benchmark == "backends":
+        from nice_processing import DEVICE, INFERENCE_BACKENDS
+        default_backends = [backend for backend in INFERENCE_BACKENDS if DEVICE == "cpu" or backend != "int8"]
+        bench_backends(args.pdf, args.pages, args.backends or default_backends)
+    elif args.benchmark == "slicing":
+        bench_slicing(args.markdown, args.sections, args.section_tokens, args.slices)
+    elif args.benchmark == "state":
+        bench_state(args.sections, args.section_tokens)
+    elif args.benchmark == "edits":
+        bench_edits(args.sections, args.section_tokens, args.edits)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+
+MANIFEST_JSON = "manifest.json"
+
+
+def read_manifest(page_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(page_dir, MANIFEST_JSON), "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def file_digest(file_path: str) -> str:
+    """sha256 of a file"""
+    with open(file_path, "rb") as fh:
+        return hashlib.file_digest(fh, "sha256").hexdigest()
+
+
+class PageCheckpoint:
+    """
+    Per page results of a document ingestion. Every finished page is written to page_dir right away
+    and recorded in a manifest, so an interrupted ingestion only has to process the missing pages.
+    The manifest is discarded when the source pdf or the generation settings change.
+    Pages may be added from the stages of the ingestion pipeline, the manifest is guarded by a lock.
+    """
+
+    def __init__(self, page_dir: str, source_digest: str, settings: dict):
+        self.page_dir = page_dir
+        self._lock = threading.Lock()
+        self.fingerprint = hashlib.sha256(
+            json.dumps({"source": source_digest, "settings": settings}, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+        os.makedirs(page_dir, exist_ok=True)
+        manifest = read_manifest(page_dir)
+        if manifest is not None and manifest["fingerprint"] == self.fingerprint:
+            self.completed = set(manifest["completed"])
+            self.flagged: Dict[int, str] = {int(page): flag for page, flag in manifest.get("flagged", {}).items()}
+            self.sources: Dict[int, str] = {int(page): source for page, source in manifest.get("sources", {}).items()}
+        else:
+            self.completed = set()
+            self.flagged = {}
+            self.sources = {}
+            self._write_manifest()
+
+    def missing_pages(self, page_count: int) -> List[int]:
+        return [page_number for page_number in range(1, page_count + 1) if page_number not in self.completed]
+
+    def add_page(self, page_number: int, image: Image.Image, doctags: str, flag: Optional[str] = None,
+                 source: Optional[str] = None):
+        """
+        Persist a finished page, the manifest is updated last so partial writes are never marked complete.
+        A flag marks pages whose doctags need a review, source records how the doctags were produced.
+        """
+        image.save(self.image_path(page_number), compress_level=1)
+        self._write_atomic(self.doctags_path(page_number), doctags)
+        with self._lock:
+            self.completed.add(page_number)
+            if flag:
+                self.flagged[page_number] = flag
+            if source:
+                self.sources[page_number] = source
+            self._write_manifest()
+
+    def add_duplicate(self, page_number: int, original_page_number: int, source: Optional[str] = None):
+        """Persist a page as a copy of the completed page it duplicates"""
+        shutil.copyfile(self.image_path(original_page_number), self.image_path(page_number))
+        shutil.copyfile(self.doctags_path(original_page_number), self.doctags_path(page_number))
+        with self._lock:
+            self.completed.add(page_number)
+            if original_page_number in self.flagged:
+                self.flagged[page_number] = self.flagged[original_page_number]
+            if source:
+                self.sources[page_number] = source
+            self._write_manifest()
+
+    def doctags(self, page_number: int) -> str:
+        with open(self.doctags_path(page_number), "r") as fh:
+            return fh.read()
+
+    def image_path(self, page_number: int) -> str:
+        return os.path.join(self.page_dir, f"page_{page_number:04d}.png")
+
+    def doctags_path(self, page_number: int) -> str:
+        return os.path.join(self.page_dir, f"page_{page_number:04d}.doctags")
+
+    def _write_manifest(self):
+        manifest = {
+            "fingerprint": self.fingerprint,
+            "completed": sorted(self.completed),
+            "flagged": {str(page_number): flag for page_number, flag in sorted(self.flagged.items())},
+            "sources": {str(page_number): source for page_number, source in sorted(self.sources.items())}
+        }
+        self._write_atomic(os.path.join(self.page_dir, MANIFEST_JSON), json.dumps(manifest))
+
+    @staticmethod
+    def _write_atomic(path: str, content: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(content)
+        os.replace(tmp_path, path)
@@ -0,0 +1,139 @@
+"""
+Headless batch ingestion of pdf files into the stage folder:
+
+    nicerslicer-ingest ./manuals "./contracts/*.pdf" --stage /workspaces/NicerSlicer/stage --jobs 4
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+from typing import Dict, List, Optional
+
+# the modules of this folder import each other by their plain name like the streamlit app does
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nice_processing import BATCH_SIZE, DOCLING_JSON, INFERENCE_BACKEND, INFERENCE_BACKENDS, NUM_WORKERS  # noqa: E402
+from jobs import DONE, FAILED, create_job, read_job, run_job, write_job  # noqa: E402
+
+
+DEFAULT_STAGE_PATH = "/workspaces/NicerSlicer/stage"
+DEFAULT_CACHE_PATH = "/workspaces/NicerSlicer/cache"
+
+
+def collect_pdfs(inputs: List[str]) -> List[str]:
+    """Resolve directories, glob patterns and files to a sorted list of pdf paths"""
+    pdf_paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.pdf")
+        pdf_paths.update(path for path in glob.glob(pattern, recursive=True) if path.lower().endswith(".pdf"))
+    return sorted(pdf_paths)
+
+
+def document_names(pdf_paths: List[str]) -> Dict[str, str]:
+    """
+    Stage folder name of every pdf, the file name without extension. Pdfs sharing a file name are told
+    apart by their path below the folder they have in common, like reports_2023_manual.
+    """
+    by_name: Dict[str, List[str]] = {}
+    for pdf_path in pdf_paths:
+        by_name.setdefault(os.path.splitext(os.path.basename(pdf_path))[0], []).append(pdf_path)
+
+    names = {}
+    for name, paths in by_name.items():
+        if len(paths) == 1:
+            names[paths[0]] = name
+            continue
+        common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+        for path in paths:
+            relative_path = os.path.relpath(os.path.splitext(os.path.abspath(path))[0], common_dir)
+            names[path] = relative_path.replace(os.sep, "_")
+    return names
+
+
+def failed_job(document: str, error: str, job: Optional[dict] = None) -> dict:
+    """Failed job of a document that was not ingested by run_job"""
+    now = time.time()
+    job = job or {"document": document, "progress": {"done": 0, "total": None}}
+    job.update(state=FAILED, error=error, started=job.get("started", now), finished=now)
+    return job
+
+
+def print_report(jobs: List[dict], seconds: float):
+    done = [job for job in jobs if job["state"] == DONE]
+    failed = [job for job in jobs if job["state"] != DONE]
+    pages = sum(job["progress"]["total"] or 0 for job in done)
+
+    print("\n---- Throughput ----")
+    for job in sorted(jobs, key=lambda job: job["document"]):
+        print(f"{job['document']:<50} {job['state']:<8} {job['progress']['total'] or 0:>5} pages "
+              f"{job['finished'] - job['started']:>8.1f} s")
+    print(f"\n{len(done)} documents, {pages} pages in {seconds:.1f} s - {pages / max(seconds, 1e-9):.2f} pages/s")
+    if failed:
+        print(f"\n{len(failed)} failed:")
+        for job in failed:
+            print(f"- {job['document']}\n{job.get('error', '')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest pdf files into the NicerSlicer stage folder")
+    parser.add_argument("inputs", nargs="+", help="pdf files, directories or glob patterns")
+    parser.add_argument("--stage", default=DEFAULT_STAGE_PATH, help="stage folder the documents are written to")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="folder of the doctags cache")
+    parser.add_argument("--jobs", type=int, default=1, help="documents processed in parallel, each loads its own model")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS, help="model replicas per document")
+    parser.add_argument("--backend", choices=INFERENCE_BACKENDS, default=INFERENCE_BACKEND)
+    parser.add_argument("--no-text-layer", action="store_true", help="send born-digital pages through the VLLM as well")
+    parser.add_argument("--force", action="store_true", help="process documents that already have a docling.json")
+    args = parser.parse_args()
+
+    pdf_paths = collect_pdfs(args.inputs)
+    names = document_names(pdf_paths)
+    name_counts = Counter(names.values())
+    documents, jobs = [], []
+    for pdf_path in pdf_paths:
+        document = names[pdf_path]
+        if name_counts[document] > 1:
+            # a disambiguated name that equals the name of another pdf, neither is processed
+            jobs.append(failed_job(document, f"{pdf_path} shares its stage folder with another pdf"))
+            continue
+        if not args.force and os.path.exists(os.path.join(args.stage, document, DOCLING_JSON)):
+            print(f"Skipping {document}, already processed")
+            continue
+        with open(pdf_path, "rb") as fh:
+            create_job(args.stage, document, fh.read(),
+                       {"batch_size": args.batch_size, "num_workers": args.workers, "backend": args.backend,
+                        "use_text_layer": not args.no_text_layer})
+        documents.append(document)
+    print(f"Processing {len(documents)} of {len(pdf_paths)} documents ...")
+    if not documents and not jobs:
+        return
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {executor.submit(run_job, args.stage, args.cache, document): document for document in documents}
+        for completed, future in enumerate(as_completed(futures), 1):
+            try:
+                job = future.result()
+            except Exception as e:
+                # a crashed worker, like one killed for running out of memory, fails its documents only
+                doc_dir = os.path.join(args.stage, futures[future])
+                job = failed_job(futures[future], f"{type(e).__name__}: {e}", read_job(doc_dir))
+                write_job(doc_dir, job)
+            jobs.append(job)
+            print(f"[{completed}/{len(documents)}] {job['document']} {job['state']}")
+    print_report(jobs, time.perf_counter() - start)
+
+    sys.exit(0 if all(job["state"] == DONE for job in jobs) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+
+# default size limit of the cache folder
+DOCTAGS_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+DOCTAGS_SUFFIX = ".doctags"
+
+
+class DoctagsCache:
+    """
+    On disk cache of page doctags addressed by the hash of the page image and the settings
+    the doctags were generated with. Entries are evicted least recently used first once the
+    cache folder exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, settings: dict, max_bytes: int = DOCTAGS_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # every setting that changes the generated doctags is part of the key
+        self._settings_digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).digest()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # estimate of the folder size, other processes sharing the folder add and evict entries as well
+        self._size = self._scan_size()
+
+    def key(self, image: Image.Image) -> str:
+        """Content address of a page image"""
+        page_hash = hashlib.sha256(self._settings_digest)
+        page_hash.update(f"{image.mode}:{image.size}".encode())
+        page_hash.update(image.tobytes())
+        return page_hash.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get cached doctags, counts a hit or miss"""
+        path = self._path(key)
+        try:
+            with open(path, "r") as fh:
+                doctags = fh.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # mark entry as recently used, another process may have evicted it since the read
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return doctags
+
+    def put(self, key: str, doctags: str):
+        """Store doctags and evict old entries if the size limit is exceeded"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(doctags)
+        replaced_size = _file_size(path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += _file_size(path) - replaced_size
+            if self._size > self.max_bytes:
+                # entries of other processes are only seen by a rescan
+                self._size = self._scan_size()
+                if self._size > self.max_bytes:
+                    self._evict()
+
+    def status(self) -> str:
+        return f"Doctags cache: {self.hits} hits, {self.misses} misses"
+
+    def _evict(self):
+        """Delete least recently used entries until the cache uses 90% of max_bytes"""
+        entries = sorted(self._entry_stats(), key=lambda entry: entry[1].st_mtime)
+        for path, stat in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            self._size -= stat.st_size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + DOCTAGS_SUFFIX)
+
+    def _entry_stats(self) -> List[Tuple[str, os.stat_result]]:
+        """Path and stat of every entry, entries evicted by other processes during the scan are left out"""
+        entries = []
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(DOCTAGS_SUFFIX):
+                    try:
+                        entries.append((entry.path, entry.stat()))
+                    except FileNotFoundError:
+                        continue
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(stat.st_size for _, stat in self._entry_stats())
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,140 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from docling_core.types.doc.document import DoclingDocument
+
+from nice_processing import DOCLING_JSON, export_markdown, read_markdown, save_markdown
+from pdfhandler import JOURNAL_SUFFIX, PDFHandler, StaleStateError
+
+
+SECTION_STATE = "sections.state"
+# json section state of older versions, read until the first save writes a sections.state
+LEGACY_SECTION_JSON = "sections.json"
+
+# a section state saved for an earlier ingestion of a document is moved aside with this suffix
+STALE_SUFFIX = ".stale"
+
+# parsed documents kept in memory, the least recently used one is dropped first
+MAX_CACHED_DOCUMENTS = 8
+
+
+def load_markdown(doc_dir: str) -> str:
+    """
+    Markdown of an ingested document from its document.md, the docling.json is only parsed to
+    regenerate a missing or outdated document.md
+    """
+    markdown = read_markdown(doc_dir)
+    if markdown is None:
+        markdown = export_markdown(DoclingDocument.load_from_json(os.path.join(doc_dir, DOCLING_JSON)))
+        save_markdown(markdown, doc_dir)
+    return markdown
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class DocumentCache:
+    """
+    Parsed PDFHandler of the documents in the stage folder, shared by all sessions of the server.
+    A handler is rebuilt only when the docling.json or the section state and its journal changed on
+    disk, its own saves through save_state do not invalidate it. The sessions share the handler of a
+    document, so they hold the lock of the document while they edit or read its sections.
+    """
+
+    def __init__(self, stage_path: str, max_documents: int = MAX_CACHED_DOCUMENTS):
+        self.stage_path = stage_path
+        self.max_documents = max_documents
+        self._lock = threading.Lock()
+        # document folder name to the mtimes of docling.json, the section state and its journal and the
+        # handler built from them
+        self._entries: OrderedDict = OrderedDict()
+        # document folder name to the lock of its handler, always taken before _lock
+        self._document_locks: Dict[str, threading.RLock] = {}
+        # document folder name to the path its stale section state was moved to, until the next save
+        self._stale_states: Dict[str, str] = {}
+
+    @staticmethod
+    def _state_path(doc_dir: str) -> str:
+        state_path = os.path.join(doc_dir, SECTION_STATE)
+        legacy_path = os.path.join(doc_dir, LEGACY_SECTION_JSON)
+        return legacy_path if not os.path.exists(state_path) and os.path.exists(legacy_path) else state_path
+
+    def _version(self, doc_dir: str) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+        state_path = self._state_path(doc_dir)
+        return _mtime(os.path.join(doc_dir, DOCLING_JSON)), _mtime(state_path), _mtime(state_path + JOURNAL_SUFFIX)
+
+    def lock(self, document: str) -> threading.RLock:
+        """Reentrant lock of a document, held while its shared handler is edited or read"""
+        with self._lock:
+            return self._document_locks.setdefault(document, threading.RLock())
+
+    def get(self, document: str) -> PDFHandler:
+        doc_dir = os.path.join(self.stage_path, document)
+        # a rebuild only holds up the sessions of this document, _lock just guards the entries
+        with self.lock(document):
+            version = self._version(doc_dir)
+            with self._lock:
+                entry = self._entries.get(document)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(document)
+                    return entry[1]
+
+            if entry is not None and entry[0][0] == version[0]:
+                # same document, only the section state changed
+                pdf_handler = entry[1]
+            else:
+                pdf_handler = PDFHandler.from_markdown(load_markdown(doc_dir))
+            if version[1] is not None:
+                try:
+                    pdf_handler.load_state(self._state_path(doc_dir))
+                except StaleStateError:
+                    # the document was ingested again, its sections start over from the new markdown and
+                    # the new state is only written with the next edit
+                    stale_path = self._set_aside(doc_dir)
+                    with self._lock:
+                        self._stale_states[document] = stale_path
+                    pdf_handler = PDFHandler.from_markdown(load_markdown(doc_dir))
+                    version = self._version(doc_dir)
+
+            self._cache(document, version, pdf_handler)
+            return pdf_handler
+
+    def save_state(self, document: str, pdf_handler: PDFHandler):
+        """Journal the section edits of a document and keep its handler cached"""
+        doc_dir = os.path.join(self.stage_path, document)
+        with self.lock(document):
+            pdf_handler.save_journal(os.path.join(doc_dir, SECTION_STATE))
+            self._cache(document, self._version(doc_dir), pdf_handler)
+            with self._lock:
+                self._stale_states.pop(document, None)
+
+    def stale_state(self, document: str) -> Optional[str]:
+        """Path a stale section state of the document was moved to, None once the document was edited again"""
+        with self._lock:
+            return self._stale_states.get(document)
+
+    def _set_aside(self, doc_dir: str) -> str:
+        """Move a stale section state and its journal aside, earlier stale states are kept as well"""
+        state_path = self._state_path(doc_dir)
+        stale_path, number = state_path + STALE_SUFFIX, 0
+        while os.path.exists(stale_path):
+            number += 1
+            stale_path = f"{state_path}{STALE_SUFFIX}.{number}"
+        os.replace(state_path, stale_path)
+        if os.path.exists(state_path + JOURNAL_SUFFIX):
+            os.replace(state_path + JOURNAL_SUFFIX, stale_path + JOURNAL_SUFFIX)
+        return stale_path
+
+    def _cache(self, document: str, version: Tuple[Optional[int], Optional[int], Optional[int]],
+               pdf_handler: PDFHandler):
+        with self._lock:
+            self._entries[document] = (version, pdf_handler)
+            self._entries.move_to_end(document)
+            if len(self._entries) > self.max_documents:
+                self._entries.popitem(last=False)
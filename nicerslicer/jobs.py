@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from doctags_cache import DoctagsCache
+from pipeline import StageTimings
+from nice_processing import (BATCH_SIZE, INFERENCE_BACKEND, MODEL_REGISTRY, NUM_WORKERS, USE_TEXT_LAYER, flagged_pages,
+                             generation_settings, ingest_pdf, ingestion_report, save_docling)
+
+
+JOB_JSON = "job.json"
+
+# number of documents ingested at the same time, every job worker holds its own model
+JOB_WORKERS = 2
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# parsed job.json of every document folder with the mtime it was read at
+_job_cache: Dict[str, Tuple[int, dict]] = {}
+_job_cache_lock = threading.Lock()
+
+
+def read_job(doc_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(doc_dir, JOB_JSON), "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_job(doc_dir: str, job: dict):
+    tmp_path = os.path.join(doc_dir, f"{JOB_JSON}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w") as fh:
+        json.dump(job, fh)
+    os.replace(tmp_path, os.path.join(doc_dir, JOB_JSON))
+
+
+def _read_job_cached(doc_dir: str) -> Optional[dict]:
+    """Read a job.json again only if it changed since the last poll, finished jobs hardly ever do"""
+    try:
+        mtime = os.stat(os.path.join(doc_dir, JOB_JSON)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _job_cache_lock:
+        entry = _job_cache.get(doc_dir)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    job = read_job(doc_dir)
+    if job is not None:
+        with _job_cache_lock:
+            _job_cache[doc_dir] = (mtime, job)
+    return job
+
+
+def list_jobs(stage_path: str, finished_limit: Optional[int] = None) -> List[dict]:
+    """
+    Queued and running jobs of the stage along with the finished_limit latest finished ones, all
+    finished jobs if finished_limit is None. Latest submission first.
+    """
+    jobs = [job for entry in os.scandir(stage_path) if entry.is_dir() and (job := _read_job_cached(entry.path))]
+    active = [job for job in jobs if job["state"] in (QUEUED, RUNNING)]
+    finished = sorted([job for job in jobs if job["state"] not in (QUEUED, RUNNING)],
+                      key=lambda job: job.get("finished", job["submitted"]), reverse=True)
+    return sorted(active + finished[:finished_limit], key=lambda job: job["submitted"], reverse=True)
+
+
+def create_job(stage_path: str, document: str, pdf_bytes: bytes, options: dict) -> dict:
+    """Store the pdf in its document folder next to a queued job"""
+    doc_dir = os.path.join(stage_path, document)
+    os.makedirs(doc_dir, exist_ok=True)
+    with open(os.path.join(doc_dir, f"{document}.pdf"), "wb") as fh:
+        fh.write(pdf_bytes)
+
+    job = {
+        "document": document,
+        "state": QUEUED,
+        "submitted": time.time(),
+        "options": options,
+        "progress": {"done": 0, "total": None},
+    }
+    write_job(doc_dir, job)
+    return job
+
+
+def run_job(stage_path: str, cache_path: str, document: str) -> dict:
+    """Ingest the pdf of a document folder, runs inside a job worker"""
+    doc_dir = os.path.join(stage_path, document)
+    job = read_job(doc_dir)
+    job.update(state=RUNNING, started=time.time())
+    write_job(doc_dir, job)
+
+    # pages the pipeline stages skip report progress from their own threads
+    progress_lock = threading.Lock()
+
+    def report_progress(done: int, total: int):
+        with progress_lock:
+            # a thread may report a count another thread already passed
+            job["progress"] = {"done": max(done, job["progress"]["done"]), "total": total}
+            write_job(doc_dir, job)
+
+    options = job["options"]
+    cache = DoctagsCache(cache_path, settings=generation_settings(options["backend"]))
+    timings = StageTimings()
+    try:
+        docling_doc = ingest_pdf(
+            file_path=os.path.join(doc_dir, f"{document}.pdf"),
+            doc_dir=doc_dir,
+            pdf_title=document,
+            batch_size=options["batch_size"],
+            num_workers=options["num_workers"],
+            cache=cache,
+            backend=options["backend"],
+            progress=report_progress,
+            use_text_layer=options.get("use_text_layer", USE_TEXT_LAYER),
+            timings=timings
+        )
+        save_docling(docling_doc, doc_dir)
+        job.update(state=DONE, messages=[ingestion_report(doc_dir), timings.report(), cache.status()],
+                   flagged=flagged_pages(doc_dir))
+    except Exception:
+        job.update(state=FAILED, error=traceback.format_exc())
+    job["finished"] = time.time()
+    write_job(doc_dir, job)
+    return job
+
+
+def warm_up_job_worker():
+    """Load the model of a job worker, returns once it is resident"""
+    MODEL_REGISTRY.warm_up(background=False)
+
+
+class JobQueue:
+    """
+    Queue of document ingestion jobs executed by worker processes, so ingestion never blocks a
+    Streamlit script run. The state and progress of a job live in the job.json of its document
+    folder, jobs that were queued or running when the server stopped are resumed on start.
+    """
+
+    def __init__(self, stage_path: str, cache_path: str, num_workers: int = JOB_WORKERS, warm_up: bool = True):
+        self.stage_path = stage_path
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        if warm_up:
+            # workers are only spawned on submit, a blocking warm-up per worker spawns all of them and
+            # keeps each busy until its model is loaded, so the next task goes to another worker
+            for _ in range(num_workers):
+                self._executor.submit(warm_up_job_worker)
+
+        for job in list_jobs(stage_path):
+            if job["state"] in (QUEUED, RUNNING):
+                self._executor.submit(run_job, self.stage_path, self.cache_path, job["document"])
+
+    def submit(self, document: str, pdf_bytes: bytes, batch_size: int = BATCH_SIZE, num_workers: int = NUM_WORKERS,
+               backend: str = INFERENCE_BACKEND, use_text_layer: bool = USE_TEXT_LAYER) -> dict:
+        """Store the pdf in its document folder and queue its ingestion"""
+        doc_dir = os.path.join(self.stage_path, document)
+        with self._lock:
+            job = read_job(doc_dir)
+            if job and job["state"] in (QUEUED, RUNNING):
+                raise ValueError(f"Document \'{document}\' is already being processed.")
+
+            job = create_job(self.stage_path, document, pdf_bytes,
+                             {"batch_size": batch_size, "num_workers": num_workers, "backend": backend,
+                              "use_text_layer": use_text_layer})
+            self._executor.submit(run_job, self.stage_path, self.cache_path, document)
+        return job
@@ -1,10 +1,30 @@
-from typing import Tuple, List
+import gc
+import os
+import json
+import time
+import threading
+import weakref
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Tuple, List, Optional, Union
 import torch
 
 from docling_core.types.doc.document import DocTagsDocument, DoclingDocument
 
 from PIL import Image
-from transformers import AutoProcessor, AutoModelForVision2Seq
+from pdf2image import convert_from_path, pdfinfo_from_path
+from transformers import AutoProcessor, AutoModelForVision2Seq, BatchFeature, GenerationConfig, StoppingCriteriaList
+from doctags_cache import DoctagsCache
+from checkpoint import PageCheckpoint, file_digest, read_manifest
+from text_layer import text_layer_doctags
+from page_filter import BLANK, DUPLICATE, PageFilter
+from pipeline import FILTER, GENERATE, PREPROCESS, RASTERIZE, StageTimings, run_stage
+from stopping_criteria import (END_OF_DOCUMENT, EndOfDocumentCriteria, RepetitionCriteria, TimeBudgetCriteria,
+                               review_flag)
 # from transformers.image_utils import load_image
 
 
@@ -12,6 +32,54 @@ VLLM_MODEL = "ds4sd/SmolDocling-256M-preview"
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# numeric precision and execution of the VLLM, int8 dynamic quantization is only available on cpu
+INFERENCE_BACKENDS = ("fp32", "bf16", "int8", "compiled")
+INFERENCE_BACKEND = "bf16"
+
+# number of pages decoded together in one generate call
+BATCH_SIZE = 4
+
+# generation budget per page, pages that exceed it are flagged for review
+MAX_NEW_TOKENS = 8192
+# decoding time budget per page, the time of a batched generate call is split between its pages
+MAX_PAGE_SECONDS = 2 * 60
+STOP_AT_END_OF_DOCUMENT = True
+STOP_ON_REPETITION = True
+
+# number of worker processes with their own model replica, 1 runs inference in the calling process
+NUM_WORKERS = 1
+
+# rasterization resolution and number of pages rasterized at once
+RASTER_DPI = 300
+RASTER_WINDOW = 4
+
+# ceiling for the longest page edge in pixels, the SmolDocling processor resizes larger pages to 2048 anyway
+MAX_IMAGE_EDGE = 2048
+
+# born-digital pages take their doctags from the pdf text layer instead of the VLLM, their page image
+# is only needed for the page geometry
+USE_TEXT_LAYER = True
+TEXT_PAGE_IMAGE_EDGE = 512
+TEXT_LAYER = "text layer"
+VLLM = "vllm"
+
+# blank pages and near duplicates of earlier pages skip the VLLM
+SKIP_REDUNDANT_PAGES = True
+EMPTY_DOCTAGS = "<doctag></doctag>"
+
+# sub folder of a document folder holding the rasterized pages
+PAGES_DIR = "pages"
+DOCLING_JSON = "docling.json"
+
+# markdown export of docling.json read by the slicer, with the version and docling.json digest it was exported from
+DOCUMENT_MD = "document.md"
+DOCUMENT_MD_META = "document.md.json"
+# bump when the markdown export changes so stored document.md files are regenerated
+MARKDOWN_VERSION = 1
+
+# seconds without use after which the resident model is released
+MODEL_IDLE_TIMEOUT = 30 * 60
+
 
 PROMPT_MESSAGES = [
     {
@@ -24,51 +92,620 @@ PROMPT_MESSAGES = [
 ]
 
 
-def pdf_to_docling(pdf_images: List[Image.Image], pdf_title: str, processor: AutoProcessor, model: AutoModelForVision2Seq) -> DoclingDocument:
+def iter_pdf_pages(file_path: str, dpi: int = RASTER_DPI, window_size: int = RASTER_WINDOW,
+                   page_numbers: Optional[List[int]] = None, max_edge: Optional[int] = None,
+                   timings: Optional[StageTimings] = None) -> Iterator[Image.Image]:
+    """
+    Rasterize the pages of a pdf lazily, holding at most window_size pages in memory.
+    With max_edge set, poppler renders every page straight to that longest edge instead of dpi.
+    With timings, the windows are rasterized on a background stage ahead of the consumer.
+    """
+    if page_numbers is None:
+        page_numbers = range(1, pdfinfo_from_path(file_path)["Pages"] + 1)
+
+    def rasterize(window: Tuple[int, int]) -> List[Image.Image]:
+        return convert_from_path(file_path, dpi=dpi, first_page=window[0], last_page=window[1], size=max_edge)
+
+    windows = _page_windows(page_numbers, window_size)
+    if timings is None:
+        yield from chain.from_iterable(map(rasterize, windows))
+    else:
+        yield from chain.from_iterable(run_stage(rasterize, windows, RASTERIZE, timings))
+
+
+def _page_windows(page_numbers: Iterable[int], window_size: int) -> Iterator[Tuple[int, int]]:
+    """Group ascending page numbers into ranges of consecutive pages with at most window_size pages"""
+    first_page = last_page = None
+    for page_number in page_numbers:
+        if first_page is not None and page_number == last_page + 1 and page_number - first_page < window_size:
+            last_page = page_number
+            continue
+        if first_page is not None:
+            yield first_page, last_page
+        first_page = last_page = page_number
+    if first_page is not None:
+        yield first_page, last_page
+
+
+def ingest_pdf(file_path: str, doc_dir: str, pdf_title: str, processor: Optional[AutoProcessor] = None,
+               model: Optional[AutoModelForVision2Seq] = None, batch_size: int = BATCH_SIZE,
+               num_workers: int = NUM_WORKERS, cache: Optional[DoctagsCache] = None,
+               backend: str = INFERENCE_BACKEND, progress: Optional[Callable[[int, int], None]] = None,
+               use_text_layer: bool = USE_TEXT_LAYER, skip_redundant_pages: bool = SKIP_REDUNDANT_PAGES,
+               timings: Optional[StageTimings] = None) -> DoclingDocument:
+    """
+    Convert a pdf to a DoclingDocument while checkpointing every finished page into the pages folder
+    of doc_dir. Pages are rasterized lazily and a rerun on the same pdf only processes the missing pages.
+    With use_text_layer, born-digital pages are built from their text layer and with skip_redundant_pages,
+    blank pages and near duplicates skip the VLLM as well. progress is called with the number of
+    finished pages and the page count, for blank pages from the preprocess stage thread.
+    The VLLM pages run through a pipeline, rasterization and preprocessing work on background threads
+    while the model generates, the busy seconds of every stage are collected in timings.
+    """
+    timings = timings if timings is not None else StageTimings()
+    checkpoint = PageCheckpoint(
+        os.path.join(doc_dir, PAGES_DIR),
+        file_digest(file_path),
+        {**generation_settings(backend), "use_text_layer": use_text_layer, "skip_redundant_pages": skip_redundant_pages}
+    )
+    page_count = pdfinfo_from_path(file_path)["Pages"]
+    missing_pages = checkpoint.missing_pages(page_count)
+    print(f"Resuming {pdf_title}: {page_count - len(missing_pages)} of {page_count} pages already processed ...")
+
+    def report_progress():
+        if progress:
+            progress(len(checkpoint.completed), page_count)
+
+    report_progress()
+
+    text_doctags = text_layer_doctags(file_path) if use_text_layer and missing_pages else {}
+    text_pages = [page_number for page_number in missing_pages if page_number in text_doctags]
+    vllm_pages = [page_number for page_number in missing_pages if page_number not in text_doctags]
+    _add_text_pages(file_path, text_pages, text_doctags, checkpoint, report_progress)
+
+    # page numbers of the images handed to the VLLM, in order
+    decoded_pages = deque()
+    # duplicate page number to the page number of its original
+    duplicates: Dict[int, int] = {}
+    page_images = _filtered_page_images(file_path, vllm_pages, checkpoint, decoded_pages, duplicates,
+                                        skip_redundant_pages, report_progress, timings)
+    page_doctags = iter_page_doctags(page_images, processor, model, batch_size, num_workers, cache, backend, timings)
+    for image, doctags in page_doctags:
+        checkpoint.add_page(decoded_pages.popleft(), image, doctags, flag=review_flag(doctags), source=VLLM)
+        report_progress()
+
+    # the originals are all done now
+    for page_number, original_page_number in duplicates.items():
+        checkpoint.add_duplicate(page_number, original_page_number, source=DUPLICATE)
+    if duplicates:
+        report_progress()
+
+    print(ingestion_report(doc_dir))
+    print(timings.report())
+
+    if checkpoint.flagged:
+        print(f"Pages to review: {checkpoint.flagged}")
+
+    page_numbers = range(1, page_count + 1)
+    return doctags_to_docling(
+        [checkpoint.doctags(page_number) for page_number in page_numbers],
+        [load_page_image(checkpoint.image_path(page_number)) for page_number in page_numbers],
+        pdf_title
+    )
+
+
+def _add_text_pages(file_path: str, text_pages: List[int], text_doctags: Dict[int, str], checkpoint: PageCheckpoint,
+                    report_progress: Callable[[], None]):
+    """Checkpoint the born-digital pages with the doctags of their text layer"""
+    text_page_images = iter_pdf_pages(file_path, page_numbers=text_pages, max_edge=TEXT_PAGE_IMAGE_EDGE)
+    for page_number, image in zip(text_pages, text_page_images):
+        checkpoint.add_page(page_number, image, text_doctags[page_number], source=TEXT_LAYER)
+        report_progress()
+
 
+def _filtered_page_images(file_path: str, vllm_pages: List[int], checkpoint: PageCheckpoint, decoded_pages: deque,
+                          duplicates: Dict[int, int], skip_redundant_pages: bool,
+                          report_progress: Callable[[], None], timings: StageTimings) -> Iterator[Image.Image]:
+    """
+    Yield the images of the VLLM pages that need decoding and append their page numbers to
+    decoded_pages. Blank pages are checkpointed right away, duplicates are collected in duplicates.
+    """
+    page_filter = PageFilter() if skip_redundant_pages else None
+    page_images = iter_pdf_pages(file_path, page_numbers=vllm_pages, max_edge=MAX_IMAGE_EDGE, timings=timings)
+    for page_number, image in zip(vllm_pages, page_images):
+        with timings.timed(FILTER):
+            verdict, original_page_number = page_filter.check(page_number, image) if page_filter else (None, None)
+        if verdict == BLANK:
+            checkpoint.add_page(page_number, image, EMPTY_DOCTAGS, source=BLANK)
+            report_progress()
+        elif verdict == DUPLICATE:
+            # the original may still be decoding, the copy is made once it is done
+            duplicates[page_number] = original_page_number
+        else:
+            decoded_pages.append(page_number)
+            yield image
+
+
+def load_page_image(image_path: str) -> Image.Image:
+    """
+    Read a checkpointed page image. A lazily opened image keeps its file open until it is loaded, so
+    the pages of a long document would exceed the open file limit when they are all opened upfront.
+    """
+    image = Image.open(image_path)
+    # closes the file of a single frame image
+    image.load()
+    return image
+
+
+def save_docling(docling_doc: DoclingDocument, doc_dir: str):
+    """Persist a DoclingDocument as the docling.json of a document folder next to its markdown export"""
+    # sessions list the documents with a docling.json, so it appears only once it is complete
+    tmp_path = os.path.join(doc_dir, f"{DOCLING_JSON}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w") as fh:
+        json.dump(docling_doc.export_to_dict(), fh)
+    os.replace(tmp_path, os.path.join(doc_dir, DOCLING_JSON))
+    save_markdown(export_markdown(docling_doc), doc_dir)
+
+
+def export_markdown(docling_doc: DoclingDocument) -> str:
+    return docling_doc.export_to_markdown(image_placeholder="")
+
+
+def save_markdown(markdown: str, doc_dir: str, docling_digest: Optional[str] = None):
+    """Store the markdown of a document with the version and the digest of the docling.json it was exported from"""
+    meta = {
+        "version": MARKDOWN_VERSION,
+        "docling_digest": docling_digest or file_digest(os.path.join(doc_dir, DOCLING_JSON)),
+    }
+    for file_name, content in ((DOCUMENT_MD, markdown), (DOCUMENT_MD_META, json.dumps(meta))):
+        tmp_path = os.path.join(doc_dir, f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as fh:
+            fh.write(content)
+        os.replace(tmp_path, os.path.join(doc_dir, file_name))
+
+
+def read_markdown(doc_dir: str) -> Optional[str]:
+    """Stored markdown of a document, None if it is missing or outdated"""
+    try:
+        with open(os.path.join(doc_dir, DOCUMENT_MD_META), "r") as fh:
+            meta = json.load(fh)
+        if (meta.get("version") != MARKDOWN_VERSION
+                or meta.get("docling_digest") != file_digest(os.path.join(doc_dir, DOCLING_JSON))):
+            return None
+        with open(os.path.join(doc_dir, DOCUMENT_MD), "r") as fh:
+            return fh.read()
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def ingestion_report(doc_dir: str) -> str:
+    """Number of pages that took the text layer and the VLLM path and that were skipped as blank or duplicate"""
+    manifest = read_manifest(os.path.join(doc_dir, PAGES_DIR)) or {}
+    sources = list(manifest.get("sources", {}).values())
+    return ", ".join(f"{source}: {sources.count(source)} pages" for source in (TEXT_LAYER, VLLM, BLANK, DUPLICATE))
+
+
+def flagged_pages(doc_dir: str) -> Dict[int, str]:
+    """Pages of an ingested document whose doctags hit the generation budget, with the reason"""
+    manifest = read_manifest(os.path.join(doc_dir, PAGES_DIR)) or {}
+    return {int(page_number): flag for page_number, flag in manifest.get("flagged", {}).items()}
+
+
+def pdf_to_docling(pdf_images: List[Image.Image], pdf_title: str, processor: Optional[AutoProcessor] = None,
+                   model: Optional[AutoModelForVision2Seq] = None, batch_size: int = BATCH_SIZE,
+                   num_workers: int = NUM_WORKERS, cache: Optional[DoctagsCache] = None,
+                   backend: str = INFERENCE_BACKEND) -> DoclingDocument:
+    """Convert page images to a DoclingDocument, pages found in the cache are not decoded again"""
+    page_doctags = iter_page_doctags(pdf_images, processor, model, batch_size, num_workers, cache, backend)
+    doctags_list = [doctags for _, doctags in page_doctags]
+    return doctags_to_docling(doctags_list, pdf_images, pdf_title)
+
+
+def doctags_to_docling(doctags_list: List[str], page_images: List[Union[Image.Image, Path]],
+                       pdf_title: str) -> DoclingDocument:
     # init docling document
     doc = DoclingDocument(name=pdf_title)
-    doctags_list = []
-
-    # Process each page with VLLM
-    for page_number, pil_image in enumerate(pdf_images, start=1):
-        print(f"Processing page {page_number} ...")
-        doctags = pdf_image_to_docling(pil_image, pdf_title, page_number, processor, model)
-        doctags_list.append(doctags)
 
     # build doctag document
-    doctags_doc = DocTagsDocument.from_doctags_and_image_pairs(doctags_list, pdf_images)
+    doctags_doc = DocTagsDocument.from_doctags_and_image_pairs(doctags_list, page_images)
     doc.load_from_doctags(doctags_doc)
 
     return doc
 
 
-def pdf_image_to_docling(image, doc_title: str, page_number: int, processor: AutoProcessor, model: AutoModelForVision2Seq) -> DoclingDocument:
-    # Prepare Inputs
-    prompt = processor.apply_chat_template(PROMPT_MESSAGES, add_generation_prompt=True)
-    inputs = processor(text=prompt, images=[image], return_tensors="pt")
+def iter_page_doctags(pdf_images: Iterable[Image.Image], processor: Optional[AutoProcessor] = None,
+                      model: Optional[AutoModelForVision2Seq] = None, batch_size: int = BATCH_SIZE,
+                      num_workers: int = NUM_WORKERS, cache: Optional[DoctagsCache] = None,
+                      backend: str = INFERENCE_BACKEND, timings: Optional[StageTimings] = None
+                      ) -> Iterator[Tuple[Image.Image, str]]:
+    """
+    Yield every page image with its doctags in page order. The pages are consumed batch by batch,
+    so a generator like iter_pdf_pages is never held in memory as a whole.
+    """
+    batches = _batched(pdf_images, batch_size)
+    timings = timings if timings is not None else StageTimings()
+    for batch, batch_doctags in _iter_batch_doctags(batches, processor, model, num_workers, cache, backend, timings):
+        yield from zip(batch, batch_doctags)
+
+
+def _batched(pdf_images: Iterable[Image.Image], batch_size: int) -> Iterator[List[Image.Image]]:
+    pdf_images = iter(pdf_images)
+    while batch := list(islice(pdf_images, batch_size)):
+        yield batch
+
+
+def _iter_batch_doctags(batches: Iterator[List[Image.Image]], processor: Optional[AutoProcessor],
+                        model: Optional[AutoModelForVision2Seq], num_workers: int, cache: Optional[DoctagsCache] = None,
+                        backend: str = INFERENCE_BACKEND, timings: Optional[StageTimings] = None
+                        ) -> Iterator[Tuple[List[Image.Image], List[str]]]:
+    """Yield every batch with its doctags in page order, only pages missing in the cache are decoded"""
+    timings = timings if timings is not None else StageTimings()
+    if num_workers > 1:
+        # every worker loads its own model once and takes the next free batch
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // num_workers), backend)
+        ) as executor:
+            # only keep two batches per worker in flight to bound the pages in memory
+            pending = deque()
+            for batch in batches:
+                keys, cached = _lookup_batch(batch, cache)
+                misses = [image for image, doctags in zip(batch, cached) if doctags is None]
+                future = executor.submit(_worker_images_to_docling, misses) if misses else None
+                pending.append((batch, keys, cached, future))
+                if len(pending) >= 2 * num_workers:
+                    batch, keys, cached, future = pending.popleft()
+                    yield batch, _merge_batch(keys, cached, _worker_result(future, timings), cache)
+            while pending:
+                batch, keys, cached, future = pending.popleft()
+                yield batch, _merge_batch(keys, cached, _worker_result(future, timings), cache)
+    elif processor is None or model is None:
+        # the resident model is only loaded once there is a page to decode, documents without VLLM
+        # pages never load it
+        first_batch = next(batches, None)
+        if first_batch is None:
+            return
+        with MODEL_REGISTRY.model(backend) as (processor, model):
+            yield from _iter_batch_doctags(chain([first_batch], batches), processor, model, num_workers, cache,
+                                           backend, timings)
+    else:
+        def prepare_batch(batch: List[Image.Image]) -> tuple:
+            keys, cached = _lookup_batch(batch, cache)
+            misses = [image for image, doctags in zip(batch, cached) if doctags is None]
+            return batch, keys, cached, prepare_inputs(misses, processor) if misses else None
+
+        # the next batches are preprocessed on a background stage while the model generates
+        for batch, keys, cached, inputs in run_stage(prepare_batch, batches, PREPROCESS, timings):
+            print(f"Processing {len(batch)} pages ({cached.count(None)} not cached) ...")
+            with timings.timed(GENERATE):
+                miss_doctags = generate_doctags(inputs, processor, model) if inputs is not None else []
+            yield batch, _merge_batch(keys, cached, miss_doctags, cache)
+
+
+def _lookup_batch(batch: List[Image.Image], cache: Optional[DoctagsCache]
+                  ) -> Tuple[List[Optional[str]], List[Optional[str]]]:
+    """Get cache keys and cached doctags of a batch, None for pages that need decoding"""
+    if cache is None:
+        return [None] * len(batch), [None] * len(batch)
+    keys = [cache.key(image) for image in batch]
+    return keys, [cache.get(key) for key in keys]
+
+
+def _merge_batch(keys: List[Optional[str]], cached: List[Optional[str]], miss_doctags: List[str],
+                 cache: Optional[DoctagsCache]) -> List[str]:
+    """Fill the decoded doctags into the gaps of the cached ones and store them in the cache"""
+    miss_doctags = iter(miss_doctags)
+    doctags_list = []
+    for key, doctags in zip(keys, cached):
+        if doctags is None:
+            doctags = next(miss_doctags)
+            if cache is not None:
+                cache.put(key, doctags)
+        doctags_list.append(doctags)
+    return doctags_list
+
+
+# model replica of a worker process, set by _init_worker
+_worker_processor: Optional[AutoProcessor] = None
+_worker_model: Optional[AutoModelForVision2Seq] = None
+
+
+def _init_worker(num_threads: int, backend: str):
+    """Load the model replica of a worker process and limit its torch threads to its share of the cores"""
+    global _worker_processor, _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_processor, _worker_model = init_processor_and_model(backend)
+
+
+def _worker_images_to_docling(images: List[Image.Image]) -> Tuple[List[str], StageTimings]:
+    print(f"Worker {os.getpid()} processing {len(images)} pages ...")
+    timings = StageTimings()
+    with timings.timed(PREPROCESS):
+        inputs = prepare_inputs(images, _worker_processor)
+    with timings.timed(GENERATE):
+        doctags = generate_doctags(inputs, _worker_processor, _worker_model)
+    return doctags, timings
+
+
+def _worker_result(future, timings: StageTimings) -> List[str]:
+    """Doctags of a worker batch, the worker stage timings are added up with the ones of the other workers"""
+    if future is None:
+        return []
+    doctags, worker_timings = future.result()
+    timings.merge(worker_timings)
+    return doctags
+
+
+def pdf_image_to_docling(image, doc_title: str, page_number: int, processor: AutoProcessor,
+                         model: AutoModelForVision2Seq) -> str:
+    return pdf_images_to_docling([image], processor, model)[0]
+
+
+def pdf_images_to_docling(images: List[Image.Image], processor: AutoProcessor,
+                          model: AutoModelForVision2Seq) -> List[str]:
+    """Convert a batch of page images to doctags with a single padded generate call"""
+    return generate_doctags(prepare_inputs(images, processor), processor, model)
+
+
+def prepare_inputs(images: List[Image.Image], processor: AutoProcessor) -> BatchFeature:
+    """Downsample a batch of pages and build its model inputs on the cpu"""
+    processor_prompt = ProcessorPrompt.of(processor)
+    return processor_prompt.inputs([preprocess_page(image, processor_prompt.max_edge) for image in images])
+
+
+def generate_doctags(inputs: BatchFeature, processor: AutoProcessor, model: AutoModelForVision2Seq) -> List[str]:
+    """Decode the prepared inputs of a batch to doctags"""
+    processor_prompt = ProcessorPrompt.of(processor)
     inputs = inputs.to(DEVICE)
 
     # Generate Outputs
-    generated_ids = model.generate(**inputs, max_new_tokens=8192)
     prompt_length = inputs.input_ids.shape[1]
-    trimmed_generated_ids = generated_ids[:, prompt_length:]
-    doctags = processor.batch_decode(
-        trimmed_generated_ids,
-        skip_special_tokens=False,
-    )[0].lstrip()
+    generated_ids = model.generate(
+        **inputs,
+        max_new_tokens=MAX_NEW_TOKENS,
+        stopping_criteria=_stopping_criteria(processor_prompt, prompt_length, model.generation_config)
+    )
+    trimmed_generated_ids = _trim_generated_ids(
+        generated_ids[:, prompt_length:],
+        model.generation_config.eos_token_id,
+        model.generation_config.pad_token_id
+    )
+    with processor_prompt.lock:
+        doctags = processor.batch_decode(
+            trimmed_generated_ids,
+            skip_special_tokens=False,
+        )
 
-    return doctags
+    return [page_doctags.lstrip() for page_doctags in doctags]
+
+
+class ProcessorPrompt:
+    """
+    Chat template prompt of a processor, built once per processor. The processor expands the image
+    placeholder of the prompt by the tile grid a page is split into, so the prompt is tokenized once
+    per grid and only the image features are computed for every page. The lock serializes the
+    tokenizer between the preprocessing stage and the decoding of the generated ids.
+    """
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, processor: AutoProcessor):
+        self.processor = processor
+        self.prompt = processor.apply_chat_template(PROMPT_MESSAGES, add_generation_prompt=True)
+        self.max_edge = model_image_edge(processor)
+        self.end_of_document_ids = processor.tokenizer.encode(END_OF_DOCUMENT, add_special_tokens=False)
+        self._grid_input_ids: Dict[tuple, List[int]] = {}
+        self.lock = threading.Lock()
+
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def of(cls, processor: AutoProcessor) -> "ProcessorPrompt":
+        with cls._instances_lock:
+            if processor not in cls._instances:
+                cls._instances[processor] = cls(processor)
+            return cls._instances[processor]
 
+    def inputs(self, images: List[Image.Image]) -> BatchFeature:
+        """Model inputs for a batch of pages, left padded"""
+        image_inputs = self.processor.image_processor(
+            [[image] for image in images], return_tensors="pt", return_row_col_info=True
+        )
+        rows, cols = image_inputs.pop("rows", None), image_inputs.pop("cols", None)
+        if rows is None or cols is None:
+            # image processors without tile grids get the prompt tokenized with every batch
+            with self.lock:
+                return self.processor(text=[self.prompt] * len(images), images=[[image] for image in images],
+                                      padding=True, return_tensors="pt")
 
-def init_processor_and_model() -> Tuple[AutoProcessor, AutoModelForVision2Seq]:
+        input_ids = []
+        for image, image_rows, image_cols in zip(images, rows, cols):
+            grid = (tuple(image_rows), tuple(image_cols))
+            if grid not in self._grid_input_ids:
+                with self.lock:
+                    self._grid_input_ids[grid] = self.processor(
+                        text=self.prompt, images=[[image]], return_tensors="pt"
+                    ).input_ids[0].tolist()
+            input_ids.append(self._grid_input_ids[grid])
+
+        prompt_length = max(len(page_input_ids) for page_input_ids in input_ids)
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        return BatchFeature({
+            "input_ids": torch.tensor([[pad_token_id] * (prompt_length - len(ids)) + ids for ids in input_ids]),
+            "attention_mask": torch.tensor([[0] * (prompt_length - len(ids)) + [1] * len(ids) for ids in input_ids]),
+            **image_inputs
+        })
+
+
+def model_image_edge(processor: AutoProcessor) -> int:
+    """Longest image edge the processor feeds to the model, capped by MAX_IMAGE_EDGE"""
+    size = getattr(processor.image_processor, "size", None) or {}
+    return min(MAX_IMAGE_EDGE, size.get("longest_edge", MAX_IMAGE_EDGE))
+
+
+def preprocess_page(image: Image.Image, max_edge: int = MAX_IMAGE_EDGE) -> Image.Image:
+    """Downsample a page so its longest edge does not exceed max_edge"""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) <= max_edge:
+        return image
+    scale = max_edge / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+
+def generation_settings(backend: str = INFERENCE_BACKEND) -> dict:
+    """Settings that determine the doctags generated for a page image"""
+    return {
+        "model": VLLM_MODEL,
+        "backend": backend,
+        "prompt": PROMPT_MESSAGES,
+        "max_new_tokens": MAX_NEW_TOKENS,
+        "max_image_edge": MAX_IMAGE_EDGE,
+        "max_page_seconds": MAX_PAGE_SECONDS,
+        "stop_at_end_of_document": STOP_AT_END_OF_DOCUMENT,
+        "stop_on_repetition": STOP_ON_REPETITION,
+    }
+
+
+def _stopping_criteria(processor_prompt: "ProcessorPrompt", prompt_length: int,
+                       generation_config: GenerationConfig) -> StoppingCriteriaList:
+    stopping_criteria = StoppingCriteriaList()
+    eos_token_id = generation_config.eos_token_id
+    finished_token_ids = [*(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]),
+                          generation_config.pad_token_id]
+    stopping_criteria.append(TimeBudgetCriteria(
+        MAX_PAGE_SECONDS, [token_id for token_id in finished_token_ids if token_id is not None]
+    ))
+    if STOP_AT_END_OF_DOCUMENT:
+        stopping_criteria.append(EndOfDocumentCriteria(processor_prompt.end_of_document_ids))
+    if STOP_ON_REPETITION:
+        stopping_criteria.append(RepetitionCriteria(prompt_length))
+    return stopping_criteria
+
+
+def _trim_generated_ids(generated_ids: torch.Tensor, eos_token_id, pad_token_id) -> List[List[int]]:
+    """
+    Cut every sequence after its first eos token and strip the padding behind sequences that were
+    stopped early in a batch
+    """
+    eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+    trimmed = []
+    for sequence in generated_ids.tolist():
+        for position, token_id in enumerate(sequence):
+            if token_id in eos_token_ids:
+                sequence = sequence[:position + 1]
+                break
+        else:
+            while sequence and sequence[-1] == pad_token_id:
+                sequence.pop()
+        trimmed.append(sequence)
+    return trimmed
+
+
+def init_processor_and_model(backend: str = INFERENCE_BACKEND) -> Tuple[AutoProcessor, AutoModelForVision2Seq]:
     # method to init AutoProcessor and VLLM
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"\'backend\' must be one of {INFERENCE_BACKENDS}, got \'{backend}\'.")
+    if backend == "int8" and DEVICE != "cpu":
+        raise ValueError("The int8 backend uses dynamic quantization which is only available on cpu.")
+
     processor = AutoProcessor.from_pretrained(VLLM_MODEL)
+    # left padding keeps the prompts of a batch aligned to the generated tokens
+    processor.tokenizer.padding_side = "left"
 
+    # cpus without a fast bf16 path run the fp32 weights faster
+    use_bf16 = backend == "bf16" or (backend == "compiled" and DEVICE == "cuda")
     model = AutoModelForVision2Seq.from_pretrained(
         VLLM_MODEL,
-        torch_dtype=torch.bfloat16,
-        _attn_implementation="flash_attention_2" if DEVICE == "cuda" else "eager"
+        torch_dtype=torch.bfloat16 if use_bf16 else torch.float32,
+        _attn_implementation="flash_attention_2" if DEVICE == "cuda" and use_bf16 else "eager"
     ).to(DEVICE)
 
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "compiled":
+        # generate calls forward once per token, the shapes change with every step
+        model.forward = torch.compile(model.forward, dynamic=True)
+
     return processor, model
+
+
+class ModelRegistry:
+    """
+    Process wide holder of the VLLM processor and model. The model is loaded once on first use
+    and shared by all callers of the process until it was idle for idle_timeout seconds.
+    """
+
+    def __init__(self, idle_timeout: float = MODEL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.RLock()
+        self._processor: Optional[AutoProcessor] = None
+        self._model: Optional[AutoModelForVision2Seq] = None
+        self.backend: Optional[str] = None
+        self._users = 0
+        self._last_used = 0.0
+        self._reaper: Optional[threading.Thread] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self, backend: str = INFERENCE_BACKEND) -> Tuple[AutoProcessor, AutoModelForVision2Seq]:
+        """Get the resident processor and model, loading them if necessary or if the backend changed"""
+        with self._lock:
+            if self._model is None or self.backend != backend:
+                print(f"Loading {VLLM_MODEL} with the {backend} backend ...")
+                self._processor, self._model = init_processor_and_model(backend)
+                self.backend = backend
+                self._start_reaper()
+            self._last_used = time.monotonic()
+            return self._processor, self._model
+
+    @contextmanager
+    def model(self, backend: str = INFERENCE_BACKEND) -> Iterator[Tuple[AutoProcessor, AutoModelForVision2Seq]]:
+        """Use the resident model, it is not released while in use"""
+        with self._lock:
+            processor, model = self.get(backend)
+            self._users += 1
+        try:
+            yield processor, model
+        finally:
+            with self._lock:
+                self._users -= 1
+                self._last_used = time.monotonic()
+
+    def warm_up(self, background: bool = True):
+        """Load the model ahead of the first request"""
+        if self.is_loaded:
+            return
+        if background:
+            threading.Thread(target=self.get, name="model-warm-up", daemon=True).start()
+        else:
+            self.get()
+
+    def release(self):
+        """Drop the resident model so its memory can be reclaimed"""
+        with self._lock:
+            if self._model is None:
+                return
+            print(f"Releasing {VLLM_MODEL} ...")
+            self._processor, self._model, self.backend = None, None, None
+        gc.collect()
+        if DEVICE == "cuda":
+            torch.cuda.empty_cache()
+
+    def _start_reaper(self):
+        if self.idle_timeout and (self._reaper is None or not self._reaper.is_alive()):
+            self._reaper = threading.Thread(target=self._release_when_idle, name="model-reaper", daemon=True)
+            self._reaper.start()
+
+    def _release_when_idle(self):
+        while self.is_loaded:
+            time.sleep(min(60, self.idle_timeout))
+            with self._lock:
+                if self._users == 0 and time.monotonic() - self._last_used >= self.idle_timeout:
+                    self.release()
+
+
+MODEL_REGISTRY = ModelRegistry()
@@ -0,0 +1,74 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+BLANK = "blank"
+DUPLICATE = "duplicate"
+
+# a page is blank if almost no pixel inside its margins differs from the background
+BLANK_CHECK_EDGE = 256
+BLANK_MARGIN = 0.05
+BLANK_INK_DELTA = 32
+BLANK_MAX_INK_RATIO = 0.001
+
+# near duplicates share a difference hash and their thumbnails hardly differ
+HASH_SIZE = 16
+DUPLICATE_MAX_HASH_DISTANCE = 10
+DUPLICATE_THUMBNAIL_EDGE = 128
+DUPLICATE_MAX_MEAN_DIFFERENCE = 1.5
+
+
+def _gray_array(gray: Image.Image, max_edge: int) -> np.ndarray:
+    scale = max_edge / max(gray.size)
+    size = (max(1, round(gray.width * scale)), max(1, round(gray.height * scale)))
+    return np.asarray(gray.resize(size, Image.BILINEAR), dtype=np.int16)
+
+
+def is_blank(gray: Image.Image) -> bool:
+    """Check if a grayscale page has (almost) no ink apart from scan borders"""
+    pixels = _gray_array(gray, BLANK_CHECK_EDGE)
+    margin_y, margin_x = int(pixels.shape[0] * BLANK_MARGIN), int(pixels.shape[1] * BLANK_MARGIN)
+    inner = pixels[margin_y:pixels.shape[0] - margin_y, margin_x:pixels.shape[1] - margin_x]
+    ink = np.abs(inner - np.median(inner)) > BLANK_INK_DELTA
+    return ink.mean() < BLANK_MAX_INK_RATIO
+
+
+def difference_hash(gray: Image.Image) -> np.ndarray:
+    """Perceptual hash of HASH_SIZE * HASH_SIZE bits comparing horizontally adjacent pixels"""
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+
+class PageFilter:
+    """
+    Pre-pass over the rasterized pages of a document that finds blank pages and near duplicates of
+    earlier pages, like repeated covers or legal boilerplate, so they can skip the VLLM.
+    """
+
+    def __init__(self):
+        self._page_numbers: List[int] = []
+        self._hashes = np.empty((0, HASH_SIZE * HASH_SIZE // 8), dtype=np.uint8)
+        self._thumbnails: List[np.ndarray] = []
+
+    def check(self, page_number: int, image: Image.Image) -> Tuple[Optional[str], Optional[int]]:
+        """Get BLANK, DUPLICATE with the page number of the original page or None for pages that need decoding"""
+        gray = image.convert("L")
+        if is_blank(gray):
+            return BLANK, None
+
+        page_hash = difference_hash(gray)
+        thumbnail = _gray_array(gray, DUPLICATE_THUMBNAIL_EDGE)
+        # hamming distance to all unique pages at once
+        distances = np.unpackbits(self._hashes ^ page_hash, axis=1).sum(axis=1)
+        for candidate in np.flatnonzero(distances <= DUPLICATE_MAX_HASH_DISTANCE):
+            candidate_thumbnail = self._thumbnails[candidate]
+            if (candidate_thumbnail.shape == thumbnail.shape
+                    and np.abs(candidate_thumbnail - thumbnail).mean() <= DUPLICATE_MAX_MEAN_DIFFERENCE):
+                return DUPLICATE, self._page_numbers[candidate]
+
+        self._page_numbers.append(page_number)
+        self._hashes = np.vstack([self._hashes, page_hash])
+        self._thumbnails.append(thumbnail)
+        return None, None
@@ -1,11 +1,38 @@
 import base64
 import json
 import zlib
+import os
+import sys
+import struct
+import hashlib
+from collections import OrderedDict
+from array import array
+from bisect import bisect_right
 from typing import Optional, List, Tuple, Literal
 from enum import Enum
 
 # from unstructured.documents.elements import CompositeElement
 
+# formatted sections kept by a SectionRenderCache
+RENDER_CACHE_SIZE = 10000
+
+# section edits are appended to a journal next to the state file, every JOURNAL_COMPACTION_ENTRIES
+# entries the state file is rewritten as a snapshot and the journal starts over
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_COMPACTION_ENTRIES = 200
+# edits that can be undone
+MAX_UNDO = 100
+
+# binary section state: header with magic, format version and section count followed by the zlib
+# compressed spans, discard flags and a json part with titles and undo history
+STATE_MAGIC = b"NSST"
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct("<4sHI")
+
+
+class StaleStateError(ValueError):
+    """A section state saved for another text of the document"""
+
 
 class SectionSate(Enum):
     # defines if the slider range is within section boundaries
@@ -15,9 +42,93 @@ class SectionSate(Enum):
     START_AND_END_SPANS = 3
 
 
+class TokenStore:
+    """
+    Tokens of a whole document as character offsets into its text. Tokens are the words of a
+    paragraph split by single spaces and a NEWLINE_TOKEN between paragraphs, sections are views
+    over token ranges, so slicing, splitting and joining sections never copies or re-tokenizes text.
+    The joined text of all tokens is rendered along with the character offset of every token in it,
+    so the text of any token range is a single substring.
+    """
+    NEWLINE_TOKEN = "<$NEWLINE$>"
+    __slots__ = ("text", "starts", "ends", "newlines", "render_offsets", "_render_parts", "_rendered", "_digest")
+
+    def __init__(self, text: str):
+        self.text = text
+        # unsigned 32 bit offsets, documents stay far below 4 GB of text
+        self.starts = array("I")
+        self.ends = array("I")
+        # 1 for the NEWLINE_TOKEN between two paragraphs
+        self.newlines = bytearray()
+        # offset of every token in the rendered text, the rendered paragraph of a line is the line
+        # followed by a space and a paragraph break
+        self.render_offsets = array("I", [0])
+        self._render_parts: List[str] = []
+        self._rendered: Optional[str] = None
+        self._digest: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def add_chunk(self, start: int, end: int) -> Tuple[int, int]:
+        """Tokenize text[start:end] and get the first and last token index of it"""
+        first_token = len(self)
+        position = start
+        for line in self.text[start:end].split("\n\n"):
+            if line.split():  # ignore empty lines
+                line_offset = self.render_offsets.pop()
+                word_start = position
+                for word in line.split(" "):
+                    self.starts.append(word_start)
+                    self.ends.append(word_start + len(word))
+                    self.newlines.append(0)
+                    self.render_offsets.append(line_offset + word_start - position)
+                    word_start += len(word) + 1
+                self.starts.append(position + len(line))
+                self.ends.append(position + len(line))
+                self.newlines.append(1)
+                self.render_offsets.append(line_offset + len(line) + 1)
+                self.render_offsets.append(line_offset + len(line) + 3)
+                self._render_parts.append(line + " \n\n")
+            position += len(line) + 2
+        if len(self) > first_token and self.newlines[-1]:
+            # remove trailing newline token
+            self.starts.pop()
+            self.ends.pop()
+            self.newlines.pop()
+            self.render_offsets.pop()
+            self._render_parts[-1] = self._render_parts[-1][:-2]
+        self._rendered = None
+        return first_token, len(self) - 1
+
+    @property
+    def digest(self) -> str:
+        """Hash of the document text, identifies the store across reruns"""
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.text.encode(), digest_size=16).hexdigest()
+        return self._digest
+
+    def token(self, index: int) -> str:
+        return self.NEWLINE_TOKEN if self.newlines[index] else self.text[self.starts[index]:self.ends[index]]
+
+    def tokens(self, start: int, end: int) -> List[str]:
+        return [self.token(index) for index in range(max(0, start), min(len(self), end))]
+
+    def join(self, start: int, end: int) -> str:
+        """Join the tokens [start, end) back to text with proper spacing and line breaks"""
+        start, end = max(0, start), min(len(self), end)
+        if start >= end:
+            return ""
+        if self._rendered is None:
+            self._rendered = "".join(self._render_parts)
+            self._render_parts = [self._rendered]
+        return self._rendered[self.render_offsets[start]:self.render_offsets[end]].rstrip()
+
+
 class Section:
     """
-    Class to handle the formatting of sections with bound markers
+    Class to handle the formatting of sections with bound markers. A section is a view over the
+    inclusive token range spans of the document token store.
     """
     # BEGIN_MARKER = "<span class='bracket-font'>:blue-background[:blue[:material/text_select_move_forward_character:]]</span>"
     # END_MARKER = "<span class='bracket-font'>:blue-background[:blue[:material/text_select_move_back_character:]]</span>"
@@ -27,45 +138,46 @@ class Section:
     END_MARKER = "<span class='bracket-font'>:red[\]]</span>"
     OPEN_BRACKET = ""
     CLOSED_BRACKET = ""
-    NEWLINE_TOKEN = "<$NEWLINE$>"
+    NEWLINE_TOKEN = TokenStore.NEWLINE_TOKEN
+    __slots__ = ("id_", "store", "spans", "title", "discarded")
 
-    def __init__(self, id_: int, text: str, title: Optional[str] = None, spans: Tuple[int, int] = (0, 0), discarded: bool = False):
+    def __init__(self, id_: int, store: TokenStore, spans: Tuple[int, int], title: Optional[str] = None,
+                 discarded: bool = False):
         self.id_ = id_
-        self.text = text
+        self.store = store
         self.spans = spans
         self.title = title
         self.discarded = discarded
-        self.tokens = self._split_text_with_linebreaks(text)
 
-    def _split_text_with_linebreaks(self, text: str) -> List[str]:
-        """Split text by newlines and spaces while preserving line breaks"""
-        tokens: List[str] = []
-        for line in text.split("\n\n"):
-            if line.split():  # ignore empty lines
-                tokens += line.split(" ")
-                tokens.append(self.NEWLINE_TOKEN)
-        if tokens and tokens[-1] == self.NEWLINE_TOKEN:
-            tokens.pop()  # remove trailing newline token
-        return tokens
+    @property
+    def text(self) -> str:
+        return self.store.join(self.spans[0], self.spans[1] + 1)
+
+    @property
+    def tokens(self) -> List[str]:
+        return self.store.tokens(self.spans[0], self.spans[1] + 1)
+
+    def __len__(self) -> int:
+        return max(0, self.spans[1] - self.spans[0] + 1)
+
+    def to_dict(self) -> dict:
+        return {"id_": self.id_, "text": self.text, "title": self.title, "spans": self.spans,
+                "discarded": self.discarded}
+
+    def to_state(self) -> list:
+        """Everything that defines the section besides the document tokens"""
+        return [self.spans[0], self.spans[1], self.title, self.discarded]
 
     def join_tokens(self, start: Optional[int] = None, end: Optional[int] = None) -> str:
-        """Join tokens back to text with proper spacing and line breaks"""
+        """Join tokens back to text with proper spacing and line breaks, start and end are relative to the section"""
         start = start if start is not None else 0
-        end = end if end is not None else len(self.tokens)
-
-        result = []
-        for token in self.tokens[start:end]:
-            if token == self.NEWLINE_TOKEN:
-                result.append("\n\n")
-            else:
-                result.append(token + " ")
-        return "".join(result).rstrip()
+        end = min(end if end is not None else len(self), len(self))
+        return self.store.join(self.spans[0] + start, self.spans[0] + end)
 
     def _slice_text(self, start: int, end: int):
         """Get text slice relative to section bounds"""
         rel_start = max(0, start - self.spans[0])
-        rel_end = min(len(self.tokens), end - self.spans[0])
-        # return " ".join(self.tokens[rel_start:rel_end])
+        rel_end = min(len(self), end - self.spans[0])
         return self.join_tokens(rel_start, rel_end)
 
     def _format_brackets(self, text: str, index: int, color: str) -> str:
@@ -82,7 +194,7 @@ class Section:
 
         if not (start_in_bounds or end_in_bounds):
             # No interaction - return plain formatted text
-            return self._format_brackets(self.text, index, color) if not is_selected else self.text
+            return self.format_text(is_selected, index, color)
 
         # Build text in parts
         text_parts = []
@@ -108,6 +220,10 @@ class Section:
         result = "".join(text_parts)
         return result if is_selected else self._format_brackets(result, index, color)
 
+    def format_text(self, is_selected: bool, index: int = None, color: str = "red") -> str:
+        """Format a section no cursor is placed in"""
+        return self._format_brackets(self.text, index, color) if not is_selected else self.text
+
     def format_section_split_text(self, cursor_pos: int):
         span_before = self._slice_text(self.spans[0], cursor_pos)
         span_after = self._slice_text(cursor_pos, self.spans[1])
@@ -120,50 +236,95 @@ class Section:
         return f"Section: {self.title} - {self.spans}"
 
 
+class SectionRenderCache:
+    """
+    Formatted markdown of sections, keyed by everything the formatting depends on: the document,
+    the section version (spans, title and discard state), its color, index and selection state and
+    the cursors placed in it. Sections without a cursor do not depend on the cursor positions, so a
+    slider move only formats the sections the cursors enter or leave.
+    """
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+
+    def format_section_text(self, section: Section, cursor_start: int, cursor_end: int, cursor_color: str,
+                            is_selected: bool, index: int = None, color: str = "red") -> str:
+        start_in_bounds = section.spans[0] <= cursor_start <= section.spans[1]
+        end_in_bounds = section.spans[0] <= cursor_end <= section.spans[1]
+        cursors = (
+            cursor_start if start_in_bounds else None, cursor_end if end_in_bounds else None, cursor_color
+        ) if start_in_bounds or end_in_bounds else None
+        key = (section.store.digest, section.spans, section.title, section.discarded, index, color, is_selected,
+               cursors)
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        text = section.format_section_text(cursor_start, cursor_end, cursor_color, is_selected, index, color)
+        self._entries[key] = text
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return text
+
+
 class PDFHandler:
+    """
+    Sections of a document as a piece table over its original text: the token store is the read only
+    buffer and every section is a piece spanning a token range of it. Splitting, joining, trimming and
+    discarding sections replace pieces and never copy or re-tokenize the text, which is materialized
+    only when a section is rendered or exported. A splice still shifts the section list and the span
+    index and renumbers the ids of all later sections, so an edit costs O(number of sections).
+    """
 
-    def __init__(self, sections: List[Section]):
+    def __init__(self, sections: List[Section], store: TokenStore):
         self.sections = sections
+        self.store = store
         self.discarded_ids = []
+        # first token of every section in section order, sections cover ascending disjoint token ranges
+        self._section_starts = [section.spans[0] for section in sections]
+        # undoable edits, every edit replaces a range of sections, and the number of applied edits
+        self.history: List[dict] = []
+        self.history_position = 0
+        # journal entries not written yet and the snapshot generation the journal belongs to
+        self._pending_entries: List[dict] = []
+        self._journal_entries = 0
+        self._generation = 0
 
     @classmethod
     def from_markdown(cls, markdown: str):
         """"""
-        # build sections
-        pdf_tokens: List[str] = []
+        # build sections as views over the document tokens
+        store = TokenStore(markdown)
         pdf_sections: List[Section] = []
 
         section_indx = 0
+        position = 0
 
         for markdwn_section in markdown.split('## '):
             if markdwn_section and markdwn_section != "\n":
                 section = Section(
                     id_=section_indx,
-                    text=markdwn_section,
+                    store=store,
+                    spans=store.add_chunk(position, position + len(markdwn_section)),
                     title=markdwn_section.split('\n')[0]
                 )
-
-                # get section tokens
-                start = len(pdf_tokens)
-                pdf_tokens.extend(section.tokens)
-                end = len(pdf_tokens) - 1
-
-                # update spans
-                section.spans = (start, end)
                 pdf_sections.append(section)
 
                 section_indx += 1
+            position += len(markdwn_section) + len('## ')
 
-        return PDFHandler(pdf_sections)
+        return PDFHandler(pdf_sections, store)
 
     @classmethod
     def from_unstructured_chunks(cls, chunks: List):
         """Method to create a PDFHandler object from unstructured chunks"""
 
-        # build sections
-        pdf_tokens: List[str] = []
+        # build sections over the chunk texts joined to one document
+        store = TokenStore("\n\n".join(comp_ele.text for comp_ele in chunks))
         pdf_sections: List[Section] = []
 
+        position = 0
         for i, comp_ele in enumerate(chunks):
             # if orig_elements in binary transform to unstructured Element objects
             if isinstance(comp_ele.metadata.orig_elements, bytes):
@@ -171,139 +332,177 @@ class PDFHandler:
 
             section = Section(
                 id_=i,
-                text=comp_ele.text,
+                store=store,
+                spans=store.add_chunk(position, position + len(comp_ele.text)),
                 title=comp_ele.metadata.orig_elements[0].text
             )
-            # Get tokens using Section's method
-            start = len(pdf_tokens)
-            pdf_tokens.extend(section.tokens)
-            end = len(pdf_tokens) - 1
-
-            # Update spans and add to sections
-            section.spans = (start, end)
             pdf_sections.append(section)
+            position += len(comp_ele.text) + len("\n\n")
 
-        return PDFHandler(pdf_sections)
+        return PDFHandler(pdf_sections, store)
 
     def to_json(self) -> str:
-        return json.dumps({"sections": [section.__dict__ for section in self.sections if not section.discarded]})
+        return json.dumps({"sections": [{**section.to_dict(), "tokens": section.tokens}
+                                        for section in self.sections if not section.discarded]})
 
     def get_pdf_tokens(self):
         """Get all tokens from PDF"""
-        return [token for section in self.sections for token in section.tokens]
+        return self.store.tokens(0, len(self.store))
+
+    def section(self, id_: int, spans: Tuple[int, int], title: Optional[str] = None,
+                discarded: bool = False) -> Section:
+        """New view over the inclusive token range spans of the document"""
+        return Section(id_=id_, store=self.store, spans=spans, title=title, discarded=discarded)
 
     def update_section_spans(self, section_index: int, start: int, end: int):
         pass
 
+    def section_index_at(self, token_index: int) -> Optional[int]:
+        """Index of the section holding a token, None for tokens outside of all sections"""
+        section_index = bisect_right(self._section_starts, token_index) - 1
+        if section_index >= 0 and token_index <= self.sections[section_index].spans[1]:
+            return section_index
+        return None
+
+    def sections_in_range(self, start: int, end: int) -> range:
+        """Indices of the sections touched by the inclusive token range [start, end]"""
+        first = bisect_right(self._section_starts, start) - 1
+        if first < 0 or self.sections[first].spans[1] < start:
+            first += 1
+        return range(first, bisect_right(self._section_starts, end))
+
+    def _splice(self, start: int, stop: int, sections: List[Section], record: bool = True):
+        """
+        Replace the sections [start, stop) and keep the span index and the section ids up to date,
+        which is linear in the number of sections after start.
+        Recorded splices are edits that can be undone and are written to the journal.
+        """
+        if record:
+            self._record({
+                "start": start,
+                "removed": [section.to_state() for section in self.sections[start:stop]],
+                "added": [section.to_state() for section in sections],
+            })
+        self.sections[start:stop] = sections
+        self._section_starts[start:stop] = [section.spans[0] for section in sections]
+        self._update_section_ids(start)
+
+    def _record(self, edit: dict):
+        del self.history[self.history_position:]
+        self.history.append(edit)
+        del self.history[:-MAX_UNDO]
+        self.history_position = len(self.history)
+        self._pending_entries.append({"op": "edit", **edit})
+
+    def _sections_from_state(self, section_states: List[list]) -> List[Section]:
+        return [self.section(id_=0, spans=(start, end), title=title, discarded=discarded)
+                for start, end, title, discarded in section_states]
+
+    def undo(self) -> bool:
+        """Revert the last edit, False if there is nothing to undo"""
+        if self.history_position == 0:
+            return False
+        self.history_position -= 1
+        edit = self.history[self.history_position]
+        self._splice(edit["start"], edit["start"] + len(edit["added"]), self._sections_from_state(edit["removed"]),
+                     record=False)
+        self._pending_entries.append({"op": "undo"})
+        return True
+
+    def redo(self) -> bool:
+        """Apply the last undone edit again, False if there is nothing to redo"""
+        if self.history_position == len(self.history):
+            return False
+        edit = self.history[self.history_position]
+        self.history_position += 1
+        self._splice(edit["start"], edit["start"] + len(edit["removed"]), self._sections_from_state(edit["added"]),
+                     record=False)
+        self._pending_entries.append({"op": "redo"})
+        return True
+
+    def _resized(self, section: Section, spans: Tuple[int, int]) -> Section:
+        return self.section(id_=section.id_, spans=spans, title=section.title, discarded=section.discarded)
+
     def discard_section(self, section_index: int):
         """Change state of section to discarded"""
-        self.sections[section_index].discarded = True
+        section = self.sections[section_index]
+        self._splice(section_index, section_index + 1, [
+            self.section(id_=section.id_, spans=section.spans, title=section.title, discarded=True)
+        ])
 
     def get_discarded_sections(self) -> List[int]:
         """Get all discarded sections"""
         return [section.id_ for section in self.sections if section.discarded]
 
     def join_sections(self, section_one_indx: int, section_two_inxd: int, new_title: str):
-        """Join two sections together"""
-        # TODO: join with leading section does not work??
-        section_to_be_joined = self.sections[min(section_one_indx, section_two_inxd)]
-
-        section_after = self.sections.pop(max(section_one_indx, section_two_inxd))
-        new_section = Section(
-            id_=section_one_indx,
-            text=section_to_be_joined.text + ' ' + section_after.text,
+        """Join two sections together, the joined section spans both of them"""
+        first_indx, last_indx = min(section_one_indx, section_two_inxd), max(section_one_indx, section_two_inxd)
+        new_section = self.section(
+            id_=first_indx,
             title=new_title,
-            spans=(section_to_be_joined.spans[0], section_after.spans[1])
+            spans=(self.sections[first_indx].spans[0], self.sections[last_indx].spans[1])
         )
 
-        self.sections[min(section_one_indx, section_two_inxd)] = new_section
-
-        # update section ids
-        self._update_section_ids()
+        self._splice(first_indx, last_indx + 1, [new_section])
 
     def commit_section_slice(self, slicer):
-        """Method to create new sections based on slicing"""
+        """
+        Method to create new sections based on slicing. Only the sections touched by the slider range
+        and the adjacent sections isolated parts are appended to are replaced.
+        """
+        section = slicer.current_section
+        start, stop = slicer.touched_sections.start, slicer.touched_sections.stop
         # first initialize new section with slider bounds
-        selected_slice = Section(
+        new_sections = [self.section(
             id_=slicer.current_section_indx,
-            text=slicer.get_slider_slice(),
-            title=slicer.current_section.title,
+            title=section.title,
             spans=(slicer.slider_start, slicer.slider_end)
-        )
-        # second check if leading and trailing sections are inbounds
-        if slicer.leading_section_inbounds:
-            leading_slice = Section(
-                id_=slicer.current_section_indx - 1,
-                text=slicer.get_leading_slice(),
-                title=slicer.leading_section_title,
-                spans=(slicer.current_section.spans[0], slicer.slider_start - 1)
-            )
-        if slicer.traling_section_inbounds:
-            trailing_slice = Section(
-                id_=slicer.current_section_indx + 1,
-                text=slicer.get_trailing_slice(),
-                title=slicer.trailing_section_title,
-                spans=(slicer.slider_end + 1, slicer.current_section.spans[1])
-            )
-        # third check if leading and trailing sections overflow
-        if slicer.leading_section_overflow:
-            leading_section = self.sections[slicer.current_section_indx - 1]
-            leading_slice = Section(
-                id_=slicer.current_section_indx - 1,
-                text=leading_section._slice_text(leading_section.spans[0], slicer.slider_start - 1),
-                spans=(leading_section.spans[0], slicer.slider_start - 1)
-            )
-            # replace leading section with new slice
-            self.sections[slicer.current_section_indx - 1] = leading_slice
-        if slicer.traling_section_overflow:
+        )]
 
-            trailing_section = self.sections[slicer.current_section_indx + 1]
-            trailing_slice = Section(
-                id_=slicer.current_section_indx + 1,
-                text=trailing_section._slice_text(slicer.slider_end + 1, trailing_section.spans[1]),
-                spans=(slicer.slider_end + 1, trailing_section.spans[1])
-            )
-            # replace trailing section with new slice
-            self.sections[slicer.current_section_indx + 1] = trailing_slice
-        # update sections
-        self.sections[slicer.current_section_indx] = selected_slice
+        # second check if leading and trailing sections are inbounds
         if slicer.leading_section_inbounds:
-            # check if adjacent or new section
+            leading_spans = (section.spans[0], slicer.slider_start - 1)
             if slicer.leading_section_inbounds_method == 0:
                 # append to leading section
-                self.sections[slicer.current_section_indx - 1].text += " " + leading_slice.text
-                # update spans
-                self.sections[slicer.current_section_indx
-                              - 1].spans = (self.sections[slicer.current_section_indx - 1].spans[0], slicer.slider_start - 1)
+                start -= 1
+                leading_section = self.sections[start]
+                new_sections.insert(0, self._resized(leading_section, (leading_section.spans[0], leading_spans[1])))
             elif slicer.leading_section_inbounds_method == 1 or slicer.leading_section_inbounds_method == 2:
-                # insert leading slice
-                self.sections.insert(slicer.current_section_indx, leading_slice)
-                # set section to discard
-                if slicer.leading_section_inbounds_method == 2:
-
-                    self.sections[slicer.current_section_indx
-                                  - 1 if slicer.current_section_indx > 0 else 0].discarded = True
-
+                # new leading section, set to discard
+                new_sections.insert(0, self.section(
+                    id_=slicer.current_section_indx,
+                    title=slicer.leading_section_title,
+                    spans=leading_spans,
+                    discarded=slicer.leading_section_inbounds_method == 2
+                ))
         if slicer.traling_section_inbounds:
-            # check if adjacent or new section
+            trailing_spans = (slicer.slider_end + 1, section.spans[1])
             if slicer.traling_section_inbounds_method == 0:
-                # append to trailing section
-                self.sections[slicer.current_section_indx + 1].text = trailing_slice.text + \
-                    " " + self.sections[slicer.current_section_indx + 1].text
-                # update spans
-                self.sections[slicer.current_section_indx
-                              + 1].spans = (slicer.slider_end + 1, self.sections[slicer.current_section_indx + 1].spans[1])
+                # prepend to trailing section
+                trailing_section = self.sections[stop]
+                stop += 1
+                new_sections.append(self._resized(trailing_section, (trailing_spans[0], trailing_section.spans[1])))
             elif slicer.traling_section_inbounds_method == 1 or slicer.traling_section_inbounds_method == 2:
-                # insert trailing slice
-                self.sections.insert(
-                    slicer.current_section_indx + 2 if slicer.leading_section_inbounds else slicer.current_section_indx + 1, trailing_slice)
-                # set section to discard
-                if slicer.traling_section_inbounds_method == 2:
-                    self.sections[slicer.current_section_indx + 1 if slicer.current_section_indx
-                                  < len(self.sections) - 1 else slicer.current_section_indx].discarded = True
+                # new trailing section, set to discard
+                new_sections.append(self.section(
+                    id_=slicer.current_section_indx,
+                    title=slicer.trailing_section_title,
+                    spans=trailing_spans,
+                    discarded=slicer.traling_section_inbounds_method == 2
+                ))
+
+        # third shrink overflowed sections to their tokens outside of the slider, sections in between are absorbed
+        if slicer.leading_section_overflow:
+            leading_section = self.sections[start]
+            if leading_section.spans[0] < slicer.slider_start:
+                new_sections.insert(0, self._resized(leading_section,
+                                                     (leading_section.spans[0], slicer.slider_start - 1)))
+        if slicer.traling_section_overflow:
+            trailing_section = self.sections[stop - 1]
+            if trailing_section.spans[1] > slicer.slider_end:
+                new_sections.append(self._resized(trailing_section, (slicer.slider_end + 1, trailing_section.spans[1])))
 
-        # update section ids
-        self._update_section_ids()
+        self._splice(start, stop, new_sections)
 
     def commit_section_slicing(self,
                                section_indx: int,
@@ -319,92 +518,193 @@ class PDFHandler:
         section = self.sections[section_indx]
 
         # create sliced section
-        sliced_section = Section(
+        new_sections = [self.section(
             id_=section_indx,
-            text=section._slice_text(cursor_start, cursor_end),
             title=new_section_title,
             spans=(cursor_start, cursor_end)
-        )
-
-        self.sections[section_indx] = sliced_section
+        )]
 
         # behavior for new section and discard same same? -> first step is to create new section
         if isolated_part_before:
             # create new section
-            section_before = Section(
+            new_sections.insert(0, self.section(
                 id_=section_indx,
-                text=section._slice_text(section.spans[0], cursor_start - 1),
                 title=part_before_title,
                 spans=(section.spans[0], cursor_start - 1)
-            )
-
-            self.sections.insert(section_indx, section_before)
+            ))
 
         if isolated_part_after:
             # create new section
-            section_after = Section(
+            new_sections.append(self.section(
                 id_=section_indx + 1,
-                text=section._slice_text(cursor_end + 1, section.spans[1]),
                 title=part_after_title,
                 spans=(cursor_end + 1, section.spans[1])
-            )
+            ))
 
-            self.sections.insert(section_indx + 2 if isolated_part_before else section_indx + 1, section_after)
+        self._splice(section_indx, section_indx + 1, new_sections)
 
-        # update section spans
-        section.spans = (cursor_start + 1, cursor_end - 1)
-
-        self._update_section_ids()
-
-    def _update_section_ids(self):
-        for i, sect in enumerate(self.sections):
-            sect.id_ = i
+    def _update_section_ids(self, start: int = 0):
+        for i in range(start, len(self.sections)):
+            self.sections[i].id_ = i
 
     def split_sections(self, section_indx: int, section_break_indx: int, first_title: str, second_title: str):
+        """Split a section in front of the token section_break_indx, both parts keep at least one token"""
         section = self.sections[section_indx]
+        if section.spans[1] <= section.spans[0]:
+            return
+        section_break_indx = min(max(section_break_indx, section.spans[0] + 1), section.spans[1])
 
-        first_section = Section(
+        first_section = self.section(
             id_=section_indx,
-            text=section._slice_text(section.spans[0], section_break_indx),
             title=first_title,
-            spans=(section.spans[0], section_break_indx)
+            spans=(section.spans[0], section_break_indx - 1)
         )
-        second_section = Section(
+        second_section = self.section(
             id_=section_indx + 1,
-            text=section._slice_text(section_break_indx, section.spans[1]),
             title=second_title,
             spans=(section_break_indx, section.spans[1])
         )
 
-        self.sections[section_indx] = first_section
-
-        self.sections.insert(section_indx + 1, second_section)
-
-        # update section ids
-        self._update_section_ids()
+        self._splice(section_indx, section_indx + 1, [first_section, second_section])
 
     def get_sections_text(self, editable_section_index: int):
         pass
 
     def save_state(self, file_path: str):
-        """Save sections state to file"""
-        state = {
-            "sections": [section.__dict__ for section in self.sections]
-        }
+        """Save a snapshot of the sections state and the undo history to file and start a new journal"""
+        self._generation += 1
+        spans = array("q", [token_index for section in self.sections for token_index in section.spans])
+        if sys.byteorder == "big":
+            spans.byteswap()
+        meta = json.dumps({
+            "generation": self._generation,
+            "store": self._store_fingerprint(),
+            "titles": [section.title for section in self.sections],
+            "history": self.history,
+            "history_position": self.history_position,
+        }).encode()
+        body = spans.tobytes() + bytes(section.discarded for section in self.sections) + meta
+
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, len(self.sections)))
+            fh.write(zlib.compress(body))
+        os.replace(tmp_path, file_path)
+        # entries of older generations are skipped on load, so a crash before the truncation is harmless
+        open(file_path + JOURNAL_SUFFIX, "w").close()
+        self._pending_entries = []
+        self._journal_entries = 0
 
-        with open(file_path, "w") as fh:
-            json.dump(state, fh, indent=3)
+    @staticmethod
+    def _read_state(file_path: str) -> Tuple[List[list], dict]:
+        """Section states and the json part of a binary state file or of a json state file of older versions"""
+        with open(file_path, "rb") as fh:
+            data = fh.read()
+
+        if not data.startswith(STATE_MAGIC):
+            state = json.loads(data)
+            section_states = [[section["spans"][0], section["spans"][1], section["title"], section["discarded"]]
+                              for section in state["sections"]]
+            return section_states, state
+
+        _, version, section_count = STATE_HEADER.unpack_from(data)
+        if version > STATE_VERSION:
+            raise ValueError(f"Section state \'{file_path}\' has version {version}, supported up to {STATE_VERSION}.")
+        body = zlib.decompress(data[STATE_HEADER.size:])
+        spans = array("q")
+        spans.frombytes(body[:section_count * 2 * spans.itemsize])
+        if sys.byteorder == "big":
+            spans.byteswap()
+        discarded = body[len(spans) * spans.itemsize:len(spans) * spans.itemsize + section_count]
+        meta = json.loads(body[len(spans) * spans.itemsize + section_count:])
+        section_states = [[spans[2 * i], spans[2 * i + 1], title, bool(discarded[i])]
+                          for i, title in enumerate(meta["titles"])]
+        return section_states, meta
+
+    def _store_fingerprint(self) -> dict:
+        """Identifies the token store the spans of a state refer to"""
+        return {"digest": self.store.digest, "tokens": len(self.store)}
+
+    def _normalized_states(self, section_states: List[list]) -> List[list]:
+        """
+        Section states clipped to the document tokens with ascending disjoint spans. A token two sections
+        share stays with the later one, the earlier section of an old split did not show its last token.
+        """
+        normalized: List[list] = []
+        for start, end, title, discarded in section_states:
+            start, end = max(start, 0), min(end, len(self.store) - 1)
+            if normalized and start <= normalized[-1][1]:
+                if start > normalized[-1][0]:
+                    normalized[-1][1] = start - 1
+                else:
+                    start = normalized[-1][1] + 1
+            if start <= end:
+                normalized.append([start, end, title, discarded])
+        return normalized
+
+    def save_journal(self, file_path: str):
+        """
+        Append the edits since the last save to the journal of a state file, the cost of a save is
+        proportional to the size of the edits. The journal is compacted into a new snapshot regularly.
+        """
+        journal_entries = self._journal_entries + len(self._pending_entries)
+        if not os.path.exists(file_path) or journal_entries >= JOURNAL_COMPACTION_ENTRIES:
+            self.save_state(file_path)
+            return
+        with open(file_path + JOURNAL_SUFFIX, "a") as fh:
+            fh.writelines(json.dumps({"generation": self._generation, **entry}) + "\n"
+                          for entry in self._pending_entries)
+        self._journal_entries += len(self._pending_entries)
+        self._pending_entries = []
 
     def load_state(self, file_path: str):
-        """Load sections state from file"""
-        with open(file_path, "r") as fh:
-            state = json.load(fh)
-
-        sections: List[Section] = []
-        for section in state["sections"]:
-            section.pop("tokens")
-            sections.append(Section(**section))
-        self.sections = [Section(**section) for section in state["sections"]]
+        """
+        Load sections state from file and replay its journal, the section texts are views over the
+        document tokens. Raises a StaleStateError if the state was saved for another document text,
+        the sections are left unchanged then.
+        """
+        section_states, state = self._read_state(file_path)
+        if "store" in state and state["store"] != self._store_fingerprint():
+            raise StaleStateError(f"Section state \'{file_path}\' belongs to another version of the document.")
+        if "store" not in state:
+            # states of older versions are not tied to the document tokens and json states of older
+            # versions were saved with overlapping spans
+            normalized_states = self._normalized_states(section_states)
+            if normalized_states != section_states:
+                # the undo history refers to the sections as saved
+                section_states, state = normalized_states, {}
+
+        self._splice(0, len(self.sections), self._sections_from_state(section_states), record=False)
+        self.history = state.get("history", [])
+        self.history_position = state.get("history_position", len(self.history))
+        self._generation = state.get("generation", 0)
+        self._journal_entries = 0
+
+        try:
+            with open(file_path + JOURNAL_SUFFIX, "r") as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn write of the last entry
+                        break
+                    if entry.pop("generation") != self._generation:
+                        continue
+                    self._replay(entry)
+                    self._journal_entries += 1
+        except FileNotFoundError:
+            pass
+        self._pending_entries = []
+
+    def _replay(self, entry: dict):
+        op = entry.pop("op")
+        if op == "edit":
+            self._splice(entry["start"], entry["start"] + len(entry["removed"]),
+                         self._sections_from_state(entry["added"]))
+        elif op == "undo":
+            self.undo()
+        elif op == "redo":
+            self.redo()
 
     @staticmethod
     def _extract_orig_elements(orig_elements):
@@ -441,12 +741,16 @@ class SectionSlicer:
         self.leading_section_title = None
         self.trailing_section_title = None
 
+        # sections the slider range reaches into, including the current one
+        touched_sections = pdf_handler.sections_in_range(slider_start, slider_end)
+        self.touched_sections = range(min(touched_sections.start, section_index),
+                                      max(touched_sections.stop, section_index + 1))
+
         # set possible cases
         self.leading_section_inbounds = slider_start > self.current_section.spans[0]
         self.traling_section_inbounds = slider_end < self.current_section.spans[1]
-        self.leading_section_overflow = slider_start < self.current_section.spans[0] and section_index > 0
-        self.traling_section_overflow = slider_end > self.current_section.spans[1] and section_index < len(
-            pdf_handler.sections) - 1
+        self.leading_section_overflow = self.touched_sections.start < section_index
+        self.traling_section_overflow = self.touched_sections.stop > section_index + 1
 
         # SECTION_OPTIONS.key
         self.leading_section_inbounds_method = 2 if self.leading_section_inbounds else None
@@ -468,27 +772,12 @@ class SectionSlicer:
 
     def get_leading_slice(self) -> str:
         """Get text of leading in bounds slice"""
-        # TODO: overflow,  not inbounds
-        return self.current_section._slice_text(self.current_section.spans[0], self.slider_start - 1)
+        return self.pdf_handler.store.join(self.current_section.spans[0], self.slider_start)
 
     def get_trailing_slice(self) -> str:
         """Get text of trailing in bounds slice"""
-        # TODO: overflow,  not inbounds
-        return self.current_section._slice_text(self.slider_end, self.current_section.spans[1] + 1)
+        return self.pdf_handler.store.join(self.slider_end + 1, self.current_section.spans[1] + 1)
 
     def get_slider_slice(self) -> str:
-        # check if inbounds or overflow into next section
-        if not self.leading_section_overflow and not self.traling_section_overflow:
-            return self.current_section._slice_text(self.slider_start, self.slider_end)
-        elif self.leading_section_overflow and not self.traling_section_overflow:
-            # get part of leading section
-            leading_section = self.pdf_handler.sections[self.current_section_indx - 1]
-            # return leading_section._slice_text(leading_section.spans[0], self.slider_end) + self.get_trailing_slice()
-            return leading_section._slice_text(self.slider_start, leading_section.spans[1]) + " " + self.current_section._slice_text(self.current_section.spans[0], self.slider_end)
-        elif not self.leading_section_overflow and self.traling_section_overflow:
-            trailing_section = self.pdf_handler.sections[self.current_section_indx + 1]
-            return self.current_section._slice_text(self.slider_start, self.current_section.spans[1]) + " " + trailing_section._slice_text(trailing_section.spans[0], self.slider_end)
-        else:
-            leading_section = self.pdf_handler.sections[self.current_section_indx - 1]
-            trailing_section = self.pdf_handler.sections[self.current_section_indx + 1]
-            return leading_section._slice_text(self.slider_start, leading_section.spans[1]) + " " + self.current_section._slice_text(self.current_section.spans[0], self.current_section.spans[1]) + " " + trailing_section._slice_text(trailing_section.spans[0], self.slider_end)
+        # the slider range may overflow into the adjacent sections, their tokens follow in the store
+        return self.pdf_handler.store.join(self.slider_start, self.slider_end + 1)
@@ -0,0 +1,116 @@
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, Optional, TypeVar
+
+
+RASTERIZE = "rasterize"
+FILTER = "filter"
+PREPROCESS = "preprocess"
+GENERATE = "generate"
+STAGES = (RASTERIZE, FILTER, PREPROCESS, GENERATE)
+
+# results a stage may run ahead of its consumer, bounds the pages held in memory
+STAGE_QUEUE_SIZE = 2
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class StageTimings:
+    """
+    Busy seconds of every stage of the ingestion pipeline, the stage with the most seconds is the
+    bottleneck. Every stage is timed by a single thread, so no lock is needed and the timings of
+    worker processes can be pickled and merged.
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def merge(self, other: "StageTimings"):
+        for stage, seconds in other.seconds.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def bottleneck(self) -> Optional[str]:
+        return max(self.seconds, key=self.seconds.get) if self.seconds else None
+
+    def report(self) -> str:
+        stages = [stage for stage in STAGES if stage in self.seconds] + sorted(set(self.seconds) - set(STAGES))
+        seconds = ", ".join(f"{stage} {self.seconds[stage]:.1f} s" for stage in stages)
+        return f"Stage timings: {seconds or 'none'} (bottleneck: {self.bottleneck()})"
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+class _StageProducer:
+    """Applies the work of a stage to its items on a background thread and puts the results in a bounded queue"""
+
+    def __init__(self, work: Callable, items: Iterable, stage: str, timings: StageTimings, max_size: int):
+        self.work = work
+        self.items = items
+        self.stage = stage
+        self.timings = timings
+        self.results = queue.Queue(maxsize=max_size)
+        self.stop = threading.Event()
+
+    def put(self, result) -> bool:
+        # give up once the consumer is gone, a blocking put would never return
+        while not self.stop.is_set():
+            try:
+                self.results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(self):
+        try:
+            for item in self.items:
+                with self.timings.timed(self.stage):
+                    result = self.work(item)
+                if not self.put(result):
+                    break
+            else:
+                self.put(_DONE)
+        except BaseException as e:
+            self.put(_Failure(e))
+        finally:
+            # stops the upstream stage when this one ends early
+            if hasattr(self.items, "close"):
+                self.items.close()
+
+
+def run_stage(work: Callable[[T], R], items: Iterable[T], stage: str, timings: StageTimings,
+              max_size: int = STAGE_QUEUE_SIZE) -> Iterator[R]:
+    """
+    Apply work to the items on a background thread and yield the results in order through a bounded
+    queue, so the stage runs at most max_size results ahead of its consumer. Stages are chained by
+    passing one stage as the items of the next. Errors of the stage are raised in the consumer.
+    """
+    producer = _StageProducer(work, items, stage, timings, max_size)
+    threading.Thread(target=producer.produce, name=f"{stage} stage", daemon=True).start()
+    try:
+        while (result := producer.results.get()) is not _DONE:
+            if isinstance(result, _Failure):
+                raise result.error
+            yield result
+    finally:
+        producer.stop.set()
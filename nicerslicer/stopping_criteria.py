@@ -0,0 +1,91 @@
+import time
+from typing import Iterable, List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+
+END_OF_DOCUMENT = "</doctag>"
+
+# a page is stuck in a loop once its last REPETITION_MIN_TOKENS tokens repeat with a period of at
+# most REPETITION_MAX_PERIOD
+REPETITION_MIN_TOKENS = 384
+REPETITION_MAX_PERIOD = 64
+# steps between two repetition checks
+REPETITION_CHECK_INTERVAL = 16
+
+
+class EndOfDocumentCriteria(StoppingCriteria):
+    """Stop a sequence as soon as it generated the end of document doctag"""
+
+    def __init__(self, stop_ids: List[int]):
+        self.stop_ids = torch.tensor(stop_ids)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if input_ids.shape[1] < len(self.stop_ids):
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        return (input_ids[:, -len(self.stop_ids):] == self.stop_ids.to(input_ids.device)).all(dim=1)
+
+
+class RepetitionCriteria(StoppingCriteria):
+    """Stop a sequence that is stuck in a degenerate loop of repeated tokens"""
+
+    def __init__(self, prompt_length: int, min_tokens: int = REPETITION_MIN_TOKENS,
+                 max_period: int = REPETITION_MAX_PERIOD, check_interval: int = REPETITION_CHECK_INTERVAL):
+        self.prompt_length = prompt_length
+        self.min_tokens = min_tokens
+        self.max_period = max_period
+        self.check_interval = check_interval
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        is_looping = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        generated_length = input_ids.shape[1] - self.prompt_length
+        if generated_length < self.min_tokens + 1 or generated_length % self.check_interval:
+            return is_looping
+
+        tail = input_ids[:, -self.min_tokens:]
+        # a tail that equals itself shifted by period tokens repeats with that period
+        for period in range(1, min(self.max_period, generated_length - self.min_tokens) + 1):
+            shifted = input_ids[:, -self.min_tokens - period:-period]
+            is_looping |= (tail == shifted).all(dim=1)
+        return is_looping
+
+
+class TimeBudgetCriteria(StoppingCriteria):
+    """
+    Stop a sequence once it used up the decoding time of one page. The sequences of a batch are
+    decoded side by side, so the time of every step is split between the sequences still generating
+    and a degenerate page does not use up the budget of the pages decoded along with it.
+    """
+
+    def __init__(self, max_seconds: float, finished_token_ids: Iterable[int]):
+        self.max_seconds = max_seconds
+        # sequences stopped early in a batch are continued with eos or padding tokens
+        self.finished_token_ids = torch.tensor(sorted(set(finished_token_ids)))
+        self._seconds: Optional[torch.Tensor] = None
+        self._last_step = time.perf_counter()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        now = time.perf_counter()
+        if self._seconds is None:
+            self._seconds = torch.zeros(input_ids.shape[0], dtype=torch.float64)
+        generating = ~torch.isin(input_ids[:, -1].cpu(), self.finished_token_ids)
+        if generating.any():
+            self._seconds[generating] += (now - self._last_step) / generating.sum().item()
+        self._last_step = now
+        return (self._seconds >= self.max_seconds).to(input_ids.device)
+
+
+def review_flag(doctags: str) -> Optional[str]:
+    """Reason why the doctags of a page need a review, None if they were generated completely"""
+    if END_OF_DOCUMENT in doctags:
+        return None
+    return "repetition" if _ends_in_loop(doctags) else "budget"
+
+
+def _ends_in_loop(text: str, min_chars: int = 1000, max_period: int = 500) -> bool:
+    tail = text[-min_chars:]
+    return any(
+        tail == text[-min_chars - period:-period]
+        for period in range(1, max_period + 1) if len(text) >= min_chars + period
+    )
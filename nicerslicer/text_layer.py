@@ -0,0 +1,117 @@
+import subprocess
+import statistics
+import xml.etree.ElementTree as ET
+from typing import Dict, List
+
+
+# a page is born-digital if its text layer has enough readable text and images cover only a small part of it
+MIN_TEXT_CHARS = 200
+MIN_PRINTABLE_RATIO = 0.95
+MAX_IMAGE_COVERAGE = 0.2
+
+# single line blocks with taller lines than the median line of the page are taken as section headers
+HEADER_HEIGHT_RATIO = 1.15
+MAX_HEADER_CHARS = 120
+
+# doctags locations are relative to the page size in this range
+DOCTAGS_LOC_RANGE = 500
+
+
+def text_layer_doctags(file_path: str) -> Dict[int, str]:
+    """
+    Doctags of all born-digital pages of a pdf built from their text layer with poppler.
+    Scanned and image heavy pages are left out and need the VLLM.
+    """
+    try:
+        pages = _bbox_layout_pages(file_path)
+        image_coverage = _image_coverage(file_path, pages)
+    except (OSError, subprocess.CalledProcessError, ET.ParseError) as e:
+        print(f"No usable text layer in {file_path}: {e}")
+        return {}
+
+    page_doctags = {}
+    for page_number, page in enumerate(pages, start=1):
+        text = "".join(word.text or "" for word in _children(page, "word", recursive=True))
+        if _is_born_digital(text, image_coverage.get(page_number, 0.0)):
+            page_doctags[page_number] = _page_doctags(page)
+    return page_doctags
+
+
+def _is_born_digital(text: str, image_coverage: float) -> bool:
+    if len(text) < MIN_TEXT_CHARS or image_coverage > MAX_IMAGE_COVERAGE:
+        return False
+    printable = sum(char.isprintable() and char != "�" for char in text)
+    return printable / len(text) >= MIN_PRINTABLE_RATIO
+
+
+def _bbox_layout_pages(file_path: str) -> List[ET.Element]:
+    """Pages of pdftotext's bbox layout, every page holds blocks of lines of words with coordinates"""
+    result = subprocess.run(["pdftotext", "-bbox-layout", file_path, "-"], capture_output=True, check=True)
+    root = ET.fromstring(result.stdout)
+    return _children(root, "page", recursive=True)
+
+
+def _image_coverage(file_path: str, pages: List[ET.Element]) -> Dict[int, float]:
+    """Share of every page covered by embedded images according to pdfimages"""
+    result = subprocess.run(["pdfimages", "-list", file_path], capture_output=True, check=True, text=True)
+    coverage: Dict[int, float] = {}
+    # skip the header and separator line
+    for line in result.stdout.splitlines()[2:]:
+        fields = line.split()
+        if len(fields) < 14 or fields[2] != "image":
+            continue
+        page_number, width, height = int(fields[0]), int(fields[3]), int(fields[4])
+        x_ppi, y_ppi = int(fields[12]), int(fields[13])
+        if not x_ppi or not y_ppi or page_number > len(pages):
+            continue
+        page = pages[page_number - 1]
+        # page sizes are in points, 72 per inch
+        page_square_inches = float(page.get("width")) / 72 * float(page.get("height")) / 72
+        image_square_inches = width / x_ppi * height / y_ppi
+        coverage[page_number] = min(1.0, coverage.get(page_number, 0.0) + image_square_inches / page_square_inches)
+    return coverage
+
+
+def _page_doctags(page: ET.Element) -> str:
+    width, height = float(page.get("width")), float(page.get("height"))
+    blocks = _children(page, "block", recursive=True)
+    line_heights = [float(line.get("yMax")) - float(line.get("yMin"))
+                    for line in _children(page, "line", recursive=True)]
+    median_line_height = statistics.median(line_heights) if line_heights else 0.0
+
+    elements = []
+    for block in blocks:
+        lines = _children(block, "line")
+        text = _join_lines([" ".join(word.text or "" for word in _children(line, "word")) for line in lines])
+        if not text.strip():
+            continue
+
+        is_header = (
+            len(lines) == 1
+            and len(text) <= MAX_HEADER_CHARS
+            and float(lines[0].get("yMax")) - float(lines[0].get("yMin")) > HEADER_HEIGHT_RATIO * median_line_height
+        )
+        tag = "section_header_level_1" if is_header else "text"
+        location = "".join(
+            f"<loc_{round(float(block.get(coordinate)) / size * DOCTAGS_LOC_RANGE)}>"
+            for coordinate, size in (("xMin", width), ("yMin", height), ("xMax", width), ("yMax", height))
+        )
+        elements.append(f"<{tag}>{location}{text}</{tag}>")
+    return "<doctag>" + "".join(elements) + "</doctag>"
+
+
+def _join_lines(lines: List[str]) -> str:
+    """Join the lines of a block to a paragraph, words hyphenated at a line break are joined again"""
+    paragraph = ""
+    for line in lines:
+        if paragraph.endswith("-") and line[:1].islower():
+            paragraph = paragraph[:-1] + line
+        else:
+            paragraph = f"{paragraph} {line}" if paragraph else line
+    return paragraph
+
+
+def _children(element: ET.Element, name: str, recursive: bool = False) -> List[ET.Element]:
+    """Child elements by local name, pdftotext writes xhtml with a namespace"""
+    elements = element.iter() if recursive else element
+    return [child for child in elements if child.tag.rsplit("}", 1)[-1] == name]
@@ -3,5 +3,10 @@ from setuptools import setup
 setup(
     name="NicerSlicer",
     version="0.0.1",
-    packages=["nicerslicer"]
+    packages=["nicerslicer"],
+    entry_points={
+        "console_scripts": [
+            "nicerslicer-ingest=nicerslicer.cli:main",
+        ]
+    }
 )
\ No newline at end of file